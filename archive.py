@@ -0,0 +1,175 @@
+from collections import Counter
+
+import gspread
+
+from row_parser import UNFORMATTED_READ, parse_date
+
+# Форматы колонок архива: значения переносятся как есть (серийные номера), показываются датой и временем
+NUMBER_FORMATS = {
+    'Дата': {'type': 'DATE', 'pattern': 'yyyy-mm-dd'},
+    'Начало': {'type': 'TIME', 'pattern': 'hh:mm:ss'},
+    'Конец': {'type': 'TIME', 'pattern': 'hh:mm:ss'},
+}
+
+
+def archive_title(worksheet_id, year):
+    """Название годовой вкладки-архива для вкладки worksheet_id
+
+    По id, а не по названию: переименование вкладки не теряет ее архивы.
+    """
+    return f"Архив {year} #{worksheet_id}"
+
+
+def split_old_rows(values, cutoff):
+    """Находит строки с датой раньше cutoff в значениях get_all_values(**UNFORMATTED_READ)
+
+    Возвращает (заголовок, {год: [строки]}, [номера строк на листе]).
+    Строки с неразборчивой датой остаются на месте.
+    """
+    header, rows = values[0], values[1:]
+    date_col = header.index('Дата')
+    by_year = {}
+    row_numbers = []
+    for row_number, row in enumerate(rows, start=2):
+        try:
+            row_date = parse_date(row[date_col])
+        except (ValueError, IndexError, OverflowError):
+            continue
+        if row_date < cutoff:
+            by_year.setdefault(row_date.year, []).append(row)
+            row_numbers.append(row_number)
+    return header, by_year, row_numbers
+
+
+def row_ranges(row_numbers):
+    """Сливает номера строк в непрерывные диапазоны [(первая, последняя)]"""
+    ranges = []
+    for row_number in sorted(row_numbers):
+        if ranges and ranges[-1][1] == row_number - 1:
+            ranges[-1][1] = row_number
+        else:
+            ranges.append([row_number, row_number])
+    return [tuple(item) for item in ranges]
+
+
+def row_key(row):
+    """Содержимое строки для сравнения: без пустых ячеек справа (ширина чтения может отличаться)"""
+    row = list(row)
+    while row and row[-1] == '':
+        row.pop()
+    return tuple(row)
+
+
+def locate_rows(values, rows):
+    """Номера строк листа (по значениям get_all_values), совпадающих с rows целиком
+
+    Одинаковые строки учитываются по количеству: каждой строке из rows — одна строка листа.
+    """
+    remaining = Counter(row_key(row) for row in rows)
+    row_numbers = []
+    for row_number, row in enumerate(values[1:], start=2):
+        key = row_key(row)
+        if remaining[key] > 0:
+            remaining[key] -= 1
+            row_numbers.append(row_number)
+    return row_numbers
+
+
+def match_rows(values, rows):
+    """Делит rows на (найденные, ненайденные) среди строк значений values (с заголовком)
+
+    Одинаковые строки учитываются по количеству, как в locate_rows.
+    """
+    present = Counter(row_key(row) for row in values[1:])
+    found, missing = [], []
+    for row in rows:
+        key = row_key(row)
+        if present[key] > 0:
+            present[key] -= 1
+            found.append(row)
+        else:
+            missing.append(row)
+    return found, missing
+
+
+def delete_rows(spreadsheet, worksheet, row_numbers):
+    """Удаляет строки листа одним batch_update"""
+    # Снизу вверх, чтобы удаление не сдвигало еще не удаленные диапазоны
+    requests = [
+        {'deleteDimension': {'range': {
+            'sheetId': worksheet.id, 'dimension': 'ROWS', 'startIndex': first - 1, 'endIndex': last
+        }}}
+        for first, last in reversed(row_ranges(row_numbers))
+    ]
+    spreadsheet.batch_update({'requests': requests})
+
+
+def open_archive(spreadsheet, worksheet_id, year, header=None):
+    """Годовая вкладка-архив; создается, если передан header, иначе None при отсутствии"""
+    title = archive_title(worksheet_id, year)
+    try:
+        return spreadsheet.worksheet(title)
+    except gspread.exceptions.WorksheetNotFound:
+        if header is None:
+            return None
+    archive = spreadsheet.add_worksheet(title=title, rows=1, cols=len(header))
+    archive.update('A1', [header])
+    requests = [
+        {'repeatCell': {
+            'range': {'sheetId': archive.id, 'startRowIndex': 1, 'startColumnIndex': i, 'endColumnIndex': i + 1},
+            'cell': {'userEnteredFormat': {'numberFormat': NUMBER_FORMATS[name]}},
+            'fields': 'userEnteredFormat.numberFormat'
+        }}
+        for i, name in enumerate(header) if name in NUMBER_FORMATS
+    ]
+    if requests:
+        spreadsheet.batch_update({'requests': requests})
+    return archive
+
+
+def archive_rows(spreadsheet, worksheet, cutoff):
+    """Переносит строки старше cutoff в годовые архивы пакетными запросами
+
+    Значения читаются неформатированными и дописываются RAW, поэтому числа и
+    даты сохраняют тип. Сначала строки дописываются в архивы (по запросу на
+    год), затем удаляются из рабочей вкладки одним batch_update; при сбое
+    между шагами строки остаются в обоих местах, но не теряются. Строки,
+    которые архив уже содержит, повторно не дописываются: следующий проход
+    только удалит их с листа, и отчеты не посчитают их дважды.
+
+    Вставки бота (в том числе других реплик) на время вызова блокирует
+    вызывающий, но пользователи могут сортировать лист и править строки.
+    Поэтому перед удалением лист перечитывается, и строки ищутся по
+    содержимому, а не по номерам первого чтения; строка, которую успели
+    изменить, остается на листе, а ее старая копия убирается из архива.
+    Блокирующий вызов, запускать в потоке. Возвращает (заголовок,
+    {год: [перенесенные строки]}) по всем годам, архивы которых менялись.
+    """
+    values = worksheet.get_all_values(**UNFORMATTED_READ)
+    if len(values) < 2:
+        return None, {}
+    header, by_year, row_numbers = split_old_rows(values, cutoff)
+    if not row_numbers:
+        return header, {}
+
+    archives = {}
+    for year, rows in by_year.items():
+        archives[year] = open_archive(spreadsheet, worksheet.id, year, header)
+        _, new_rows = match_rows(archives[year].get_all_values(**UNFORMATTED_READ), rows)
+        if new_rows:
+            archives[year].append_rows(new_rows)
+
+    # Свежие номера перенесенных строк; окно до удаления — один запрос, а не вся запись архивов
+    current = worksheet.get_all_values(**UNFORMATTED_READ)
+    moved = {}
+    for year, rows in by_year.items():
+        found, changed = match_rows(current, rows)
+        moved[year] = found
+        if changed:
+            # Строку изменили или удалили во время прохода — в архиве ее копии не место
+            archive = archives[year]
+            delete_rows(spreadsheet, archive, locate_rows(archive.get_all_values(**UNFORMATTED_READ), changed))
+    row_numbers = locate_rows(current, [row for rows in moved.values() for row in rows])
+    if row_numbers:
+        delete_rows(spreadsheet, worksheet, row_numbers)
+    return header, moved
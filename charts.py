@@ -0,0 +1,64 @@
+import io
+from importlib.util import find_spec
+
+# matplotlib — необязательная зависимость: без нее отчеты остаются текстовыми
+CHARTS_AVAILABLE = find_spec('matplotlib') is not None
+
+# Сколько тегов рисовать отдельно; остальные сливаются в «другое»
+MAX_CHART_TAGS = 6
+
+
+def hours_by_day_and_tag(rows, days, tag_name):
+    """Матрица часов для графика: (теги, [[часы по дням] на каждый тег])
+
+    rows — пары (дата, {tag_id: часы}), tag_name — функция tag_id -> подпись.
+    """
+    day_index = {day: i for i, day in enumerate(days)}
+    totals = {}
+    for row_date, tags in rows:
+        for tag_id, hours in tags.items():
+            totals[tag_id] = totals.get(tag_id, 0) + hours
+
+    top = sorted(totals, key=totals.get, reverse=True)[:MAX_CHART_TAGS]
+    series = {tag_id: [0.0] * len(days) for tag_id in top}
+    other = [0.0] * len(days)
+    for row_date, tags in rows:
+        i = day_index.get(row_date)
+        if i is None:
+            continue
+        for tag_id, hours in tags.items():
+            (series[tag_id] if tag_id in series else other)[i] += hours
+
+    labels = [tag_name(tag_id) for tag_id in top]
+    matrix = [series[tag_id] for tag_id in top]
+    if any(other):
+        labels.append('другое')
+        matrix.append(other)
+    return labels, [[round(hours, 2) for hours in values] for values in matrix]
+
+
+def render_hours_chart(day_labels, tag_labels, matrix, title):
+    """Рисует столбчатый график часов по дням с разбивкой по тегам и возвращает PNG
+
+    Выполняется в отдельном процессе, поэтому matplotlib импортируется здесь.
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    fig, ax = plt.subplots(figsize=(8, 4.5), dpi=100)
+    bottom = [0.0] * len(day_labels)
+    for label, values in zip(tag_labels, matrix):
+        ax.bar(day_labels, values, bottom=bottom, label=label)
+        bottom = [b + v for b, v in zip(bottom, values)]
+
+    ax.set_title(title)
+    ax.set_ylabel('Часы')
+    if tag_labels:
+        ax.legend(loc='upper left', fontsize='small')
+    fig.tight_layout()
+
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format='png')
+    plt.close(fig)
+    return buffer.getvalue()
@@ -0,0 +1,50 @@
+DEDUPE_CAPACITY = 10000  # сколько последних update_id помним
+DEDUPE_WINDOW = 600      # секунд: дольше Telegram повтор не держит
+
+
+class UpdateDeduplicator:
+    """Отсеивает повторные доставки вебхука по update_id
+
+    Кольцевой буфер фиксированного размера хранит порядок поступления,
+    множество — быстрый поиск. Id забывается по истечении окна или когда
+    буфер заполнен, поэтому память не растет.
+    """
+
+    def __init__(self, capacity=DEDUPE_CAPACITY, window=DEDUPE_WINDOW):
+        self.capacity = capacity
+        self.window = window
+        self._ids = [None] * capacity
+        self._times = [0.0] * capacity
+        self._start = 0  # индекс самой старой записи
+        self._size = 0
+        self._seen = set()
+        self.accepted = 0
+        self.duplicates = 0
+
+    def _drop_oldest(self):
+        self._seen.discard(self._ids[self._start])
+        self._ids[self._start] = None
+        self._start = (self._start + 1) % self.capacity
+        self._size -= 1
+
+    def is_duplicate(self, update_id, now):
+        """True, если update_id уже приходил в пределах окна; иначе запоминает его"""
+        while self._size and now - self._times[self._start] > self.window:
+            self._drop_oldest()
+
+        if update_id in self._seen:
+            self.duplicates += 1
+            return True
+
+        if self._size == self.capacity:
+            self._drop_oldest()
+        end = (self._start + self._size) % self.capacity
+        self._ids[end] = update_id
+        self._times[end] = now
+        self._size += 1
+        self._seen.add(update_id)
+        self.accepted += 1
+        return False
+
+    def stats(self):
+        return {'accepted': self.accepted, 'duplicates': self.duplicates, 'tracked': self._size}
@@ -0,0 +1,92 @@
+import re
+import zlib
+from datetime import datetime, timedelta
+
+DIGEST_DAILY = 'daily'
+DIGEST_WEEKLY = 'weekly'
+
+DEFAULT_WEEKDAY = 4        # пятница
+DEFAULT_TIME = (18, 0)
+
+WEEKDAYS = {
+    'пн': 0, 'вт': 1, 'ср': 2, 'чт': 3, 'пт': 4, 'сб': 5, 'вс': 6,
+    'mon': 0, 'tue': 1, 'wed': 2, 'thu': 3, 'fri': 4, 'sat': 5, 'sun': 6,
+}
+WEEKDAY_NAMES = ['пн', 'вт', 'ср', 'чт', 'пт', 'сб', 'вс']
+TIME_PATTERN = re.compile(r'^([01]?\d|2[0-3]):([0-5]\d)$')
+
+
+class DigestPreference:
+    """Подписка пользователя на дайджест: как часто и во сколько по его времени"""
+    __slots__ = ('period', 'weekday', 'hour', 'minute', 'last_sent')
+
+    def __init__(self, period, weekday=DEFAULT_WEEKDAY, hour=DEFAULT_TIME[0], minute=DEFAULT_TIME[1], last_sent=None):
+        self.period = period
+        self.weekday = weekday
+        self.hour = hour
+        self.minute = minute
+        self.last_sent = last_sent  # локальная дата последней отправки (ISO)
+
+    def describe(self):
+        when = f"{self.hour:02d}:{self.minute:02d}"
+        if self.period == DIGEST_DAILY:
+            return f"ежедневно в {when}"
+        return f"еженедельно, {WEEKDAY_NAMES[self.weekday]} в {when}"
+
+    def to_dict(self):
+        return {
+            'period': self.period, 'weekday': self.weekday,
+            'hour': self.hour, 'minute': self.minute, 'last_sent': self.last_sent
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['period'], data['weekday'], data['hour'], data['minute'], data.get('last_sent'))
+
+
+def parse_digest_args(args):
+    """Аргументы /digest: «daily 19:00», «weekly пт 18:00», «weekly»
+
+    Возвращает DigestPreference, ValueError с текстом для пользователя при ошибке.
+    """
+    period = args[0].lower() if args else ''
+    if period not in (DIGEST_DAILY, DIGEST_WEEKLY):
+        raise ValueError("Укажите daily или weekly")
+    preference = DigestPreference(period)
+    for arg in args[1:]:
+        arg = arg.lower()
+        match = TIME_PATTERN.match(arg)
+        if match:
+            preference.hour, preference.minute = int(match.group(1)), int(match.group(2))
+        elif period == DIGEST_WEEKLY and (arg[:3] in WEEKDAYS or arg[:2] in WEEKDAYS):
+            preference.weekday = WEEKDAYS.get(arg[:3], WEEKDAYS.get(arg[:2]))
+        else:
+            raise ValueError(f"Не понял «{arg}»: нужен день недели (пн…вс) или время ЧЧ:ММ")
+    return preference
+
+
+def jitter_seconds(user_id, window):
+    """Постоянный для пользователя сдвиг в пределах окна: отправки не приходят разом"""
+    return zlib.crc32(str(user_id).encode()) % max(int(window), 1)
+
+
+def is_due(preference, user_id, local_now, window):
+    """Пора ли отправить дайджест: наступило время подписки плюс сдвиг, и сегодня еще не отправляли"""
+    if preference.period == DIGEST_WEEKLY and local_now.weekday() != preference.weekday:
+        return False
+    if preference.last_sent == local_now.date().isoformat():
+        return False
+    midnight = datetime.combine(local_now.date(), datetime.min.time())
+    scheduled = midnight + timedelta(
+        hours=preference.hour, minutes=preference.minute, seconds=jitter_seconds(user_id, window)
+    )
+    # Сдвиг не переносит отправку на завтра
+    scheduled = min(scheduled, midnight + timedelta(hours=23, minutes=59))
+    return local_now.replace(tzinfo=None) >= scheduled
+
+
+def digest_period(preference, today):
+    """(начало, конец) периода дайджеста — как у отчета за неделю"""
+    if preference.period == DIGEST_DAILY:
+        return today, today
+    return today - timedelta(days=7), today
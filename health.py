@@ -0,0 +1,65 @@
+import asyncio
+import time
+
+PROBE_TIMEOUT = 10  # секунд на одну проверку
+
+
+class ProbeResult:
+    """Результат последней проверки зависимости"""
+    __slots__ = ('ok', 'checked_at', 'latency', 'error')
+
+    def __init__(self, ok, checked_at, latency, error=None):
+        self.ok = ok
+        self.checked_at = checked_at
+        self.latency = latency
+        self.error = error
+
+
+class HealthProbes:
+    """Фоновые проверки внешних зависимостей для /ready
+
+    Проверки запускает периодическая задача, а /ready отдает запомненные
+    результаты: запрос к эндпоинту не обращается ни к Telegram, ни к Google.
+    """
+
+    def __init__(self, max_age):
+        self.max_age = max_age  # секунд, после которых результат считается устаревшим
+        self._probes = {}       # {название: async функция без аргументов}
+        self._results = {}      # {название: ProbeResult}
+
+    def register(self, name, probe):
+        self._probes[name] = probe
+
+    async def _run(self, name, probe):
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(probe(), PROBE_TIMEOUT)
+        except Exception as e:
+            self._results[name] = ProbeResult(False, time.time(), time.monotonic() - started, str(e) or type(e).__name__)
+        else:
+            self._results[name] = ProbeResult(True, time.time(), time.monotonic() - started)
+
+    async def refresh(self):
+        await asyncio.gather(*(self._run(name, probe) for name, probe in self._probes.items()))
+
+    def status(self):
+        """{'ready': bool, 'checks': {...}} по последним результатам"""
+        now = time.time()
+        checks = {}
+        ready = True
+        for name in self._probes:
+            result = self._results.get(name)
+            if result is None:
+                checks[name] = {'ok': False, 'error': 'еще не проверялось'}
+                ready = False
+                continue
+            fresh = now - result.checked_at <= self.max_age
+            checks[name] = {
+                'ok': result.ok and fresh,
+                'age': round(now - result.checked_at, 1),
+                'latency': round(result.latency, 3),
+            }
+            if result.error:
+                checks[name]['error'] = result.error
+            ready = ready and result.ok and fresh
+        return {'ready': ready, 'checks': checks}
@@ -0,0 +1,106 @@
+import csv
+import time
+
+import gspread
+
+from row_parser import parse_date, parse_hours, parse_time
+
+# Названия колонок CSV, которые понимает импорт -> колонка таблицы
+IMPORT_COLUMNS = {
+    'дата': 'Дата', 'date': 'Дата',
+    'начало': 'Начало', 'start': 'Начало',
+    'конец': 'Конец', 'end': 'Конец',
+    'часы': 'Часы', 'hours': 'Часы', 'duration': 'Часы',
+    'задача': 'Задача', 'task': 'Задача', 'description': 'Задача',
+    'теги': 'Теги', 'tags': 'Теги',
+}
+
+MAX_ROW_HOURS = 24        # строка — работа за один день
+CHUNK_ROWS = 500          # строк в одном запросе записи
+MIN_WRITE_INTERVAL = 1.1  # секунд между запросами: квота Sheets — 60 записей в минуту
+MAX_RETRIES = 5
+
+
+class CsvImportError(ValueError):
+    """Файл нельзя импортировать целиком (нет нужных колонок, не CSV)"""
+
+
+def open_csv(path):
+    """Открывает CSV в нужной кодировке и с угаданным разделителем; возвращает (файл, reader)"""
+    with open(path, 'rb') as raw:
+        head = raw.read(65536)
+    try:
+        head.decode('utf-8-sig')
+        encoding = 'utf-8-sig'
+    except UnicodeDecodeError:
+        # Выгрузки из русского Excel часто в cp1251
+        encoding = 'cp1251'
+
+    sample = head.decode(encoding, errors='ignore')
+    try:
+        dialect = csv.Sniffer().sniff(sample, delimiters=',;\t')
+    except csv.Error:
+        dialect = csv.excel
+    handle = open(path, encoding=encoding, newline='')
+    return handle, csv.reader(handle, dialect)
+
+
+def read_import_rows(reader, canonical_tags):
+    """Построчно проверяет CSV и выдает ('row', values) или ('error', номер строки, причина)"""
+    header = next(reader, None)
+    if not header:
+        raise CsvImportError("Файл пустой")
+    columns = {i: IMPORT_COLUMNS.get(name.strip().lower()) for i, name in enumerate(header)}
+    present = set(columns.values())
+    if not {'Дата', 'Часы', 'Задача'} <= present:
+        raise CsvImportError("Нужны колонки «Дата», «Часы» и «Задача»")
+
+    for line_no, record in enumerate(reader, start=2):
+        if not any(cell.strip() for cell in record):
+            continue
+        values = {columns[i]: cell.strip() for i, cell in enumerate(record) if columns.get(i)}
+        try:
+            values['Дата'] = parse_date(values['Дата']).strftime('%Y-%m-%d')
+            hours = round(parse_hours(values['Часы']), 2)
+            if not 0 < hours <= MAX_ROW_HOURS:
+                raise ValueError(f"часы должны быть больше 0 и не больше {MAX_ROW_HOURS}: {values['Часы']}")
+            values['Часы'] = hours
+            # Время пишется значением (USER_ENTERED): пропускаем только настоящее время, не формулы
+            for column in ('Начало', 'Конец'):
+                if values.get(column):
+                    values[column] = parse_time(values[column])
+        except (ValueError, KeyError, OverflowError) as e:
+            yield 'error', line_no, str(e) or 'нет значения'
+            continue
+        if not values.get('Задача'):
+            yield 'error', line_no, 'пустая задача'
+            continue
+        values['Теги'] = canonical_tags(values.get('Теги', ''))
+        yield 'row', values
+
+
+def write_chunk(worksheet, rows, last_write):
+    """Дописывает строки (row_parser.sheet_row) одним запросом с паузой по квоте и повтором при 429/5xx
+
+    Блокирующий вызов, запускать в потоке. Возвращает время записи.
+    """
+    wait = MIN_WRITE_INTERVAL - (time.monotonic() - last_write)
+    if wait > 0:
+        time.sleep(wait)
+
+    for attempt in range(MAX_RETRIES):
+        try:
+            worksheet.append_rows(rows, value_input_option='USER_ENTERED')
+            return time.monotonic()
+        except gspread.exceptions.APIError as e:
+            status = getattr(getattr(e, 'response', None), 'status_code', None)
+            retryable = status == 429 or (status is not None and status >= 500)
+            if not retryable or attempt == MAX_RETRIES - 1:
+                raise
+            time.sleep(2 ** attempt * 5)
+
+
+def format_errors(errors):
+    """Список ошибок строк для сообщения пользователю"""
+    return '\n'.join(f"• строка {line_no}: {reason}" for line_no, reason in errors)
+
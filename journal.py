@@ -0,0 +1,118 @@
+import itertools
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+RETRY_BASE_DELAY = 30     # секунд до первой повторной попытки
+RETRY_MAX_DELAY = 3600    # дальше раза в час
+COMPACT_AFTER_DONE = 500  # после стольких записанных задач файл переписывается
+
+
+class JournalEntry:
+    """Завершенная задача, которая ждет записи в таблицу"""
+    __slots__ = ('id', 'user_id', 'rows', 'attempts', 'next_attempt')
+
+    def __init__(self, entry_id, user_id, rows, attempts=0, next_attempt=None):
+        self.id = entry_id
+        self.user_id = user_id
+        self.rows = rows
+        self.attempts = attempts
+        # None — запись сейчас идет, иначе время следующей попытки
+        self.next_attempt = next_attempt
+
+
+class Journal:
+    """Локальный журнал завершенных задач (JSONL, только дописывание)
+
+    Задача попадает в журнал до записи в Google и снимается с него после
+    успешной записи, поэтому недоступность Google или перезапуск ее не теряют.
+    Методы пишут на диск с fsync и не потокобезопасны: вызывать их из одного
+    потока, не из цикла событий.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._entries = {}  # {entry_id: JournalEntry} — еще не записанные задачи
+        self._ids = itertools.count(1)
+        self._done_since_compact = 0
+
+    def _append_record(self, record):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def load(self):
+        """Читает журнал прошлого запуска; незаписанные задачи сразу готовы к повтору"""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, encoding='utf-8') as f:
+            for line_no, line in enumerate(f, start=1):
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Оборванная последняя строка после аварийной остановки
+                    logger.warning(f"Пропущена поврежденная строка журнала {line_no}")
+                    continue
+                if record['op'] == 'add':
+                    self._entries[record['id']] = JournalEntry(record['id'], record['user_id'], record['rows'])
+                elif record['op'] == 'fail' and record['id'] in self._entries:
+                    self._entries[record['id']].attempts = record['attempts']
+                elif record['op'] == 'done':
+                    self._entries.pop(record['id'], None)
+        for entry in self._entries.values():
+            entry.next_attempt = 0
+        if self._entries:
+            self._ids = itertools.count(max(self._entries) + 1)
+        self.compact()
+
+    def compact(self):
+        """Переписывает файл, оставляя только незаписанные задачи"""
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for entry in self._entries.values():
+                f.write(json.dumps(
+                    {'op': 'add', 'id': entry.id, 'user_id': entry.user_id, 'rows': entry.rows},
+                    ensure_ascii=False
+                ) + '\n')
+                if entry.attempts:
+                    f.write(json.dumps({'op': 'fail', 'id': entry.id, 'attempts': entry.attempts}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self._done_since_compact = 0
+
+    def append(self, user_id, rows):
+        """Заносит задачу в журнал до записи в таблицу"""
+        entry = JournalEntry(next(self._ids), user_id, rows)
+        self._append_record({'op': 'add', 'id': entry.id, 'user_id': user_id, 'rows': rows})
+        self._entries[entry.id] = entry
+        return entry
+
+    def mark_done(self, entry):
+        self._append_record({'op': 'done', 'id': entry.id})
+        self._entries.pop(entry.id, None)
+        self._done_since_compact += 1
+        if self._done_since_compact >= COMPACT_AFTER_DONE:
+            self.compact()
+
+    def mark_failed(self, entry, now):
+        """Планирует повтор с экспоненциальной задержкой"""
+        entry.attempts += 1
+        entry.next_attempt = now + min(RETRY_BASE_DELAY * 2 ** (entry.attempts - 1), RETRY_MAX_DELAY)
+        self._append_record({'op': 'fail', 'id': entry.id, 'attempts': entry.attempts})
+
+    def due(self, now):
+        """Задачи, которым пора повторить запись; помечаются как идущие"""
+        entries = [
+            entry for entry in self._entries.values()
+            if entry.next_attempt is not None and entry.next_attempt <= now
+        ]
+        for entry in entries:
+            entry.next_attempt = None
+        return entries
+
+    def __len__(self):
+        return len(self._entries)
@@ -1,10 +1,17 @@
 import os
 import re
+import time
+import signal
+import threading
+import asyncio
 import logging
+import multiprocessing
+import itertools
 from datetime import datetime, timedelta
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest
 from telegram.ext import (
     Application,
     ApplicationBuilder,
@@ -16,8 +23,29 @@ from telegram.ext import (
     TypeHandler,
     filters
 )
+from aiohttp import web
 import json
+import pytz
+from functools import lru_cache
 from tempfile import NamedTemporaryFile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from timers import TimerRegistry, format_intervals, split_by_day, IDLE_REMIND, IDLE_STALE
+from tags import TagIndex
+from rollups import RollupCache, ReportCache, build_daily_rollup, merge_rollups, sum_period
+from sheet_changes import SheetChangeDetector
+from row_parser import UNFORMATTED_READ, parse_records, records_from_values, sheet_row
+import importer
+import archive
+from journal import Journal
+from sheet_registry import SpreadsheetRegistry
+from charts import CHARTS_AVAILABLE, hours_by_day_and_tag, render_hours_chart
+from rate_limiter import PriorityRateLimiter, PRIORITY_BULK
+import digests
+from health import HealthProbes
+from webhook_server import create_web_app
+from dedupe import UpdateDeduplicator
+from sqlite_persistence import SQLitePersistence
+from state_store import create_state_store, StaleStateError
 
 # Настройка логирования
 logging.basicConfig(
@@ -27,14 +55,12 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # Константы для состояний разговора
-START, TASK_DESCRIPTION, TASK_TAGS = range(3)
+START, TASK_DESCRIPTION, TASK_TAGS, IMPORT_FILE = range(4)
 
 TOKEN = os.getenv('TELEGRAM_TOKEN')
 if not TOKEN:
     raise ValueError("Токен не найден! Проверьте переменные окружения.")
 
-application = ApplicationBuilder().token(TOKEN).build()
-
 
 # Настройки Google Sheets
 SCOPES = [
@@ -42,7 +68,9 @@ SCOPES = [
     'https://www.googleapis.com/auth/drive'
 ]
 
-initialized_sheets = {}
+# Проверенные таблицы: название, вкладки, заголовки и статус доступа
+SHEET_REGISTRY_TTL = int(os.getenv('SHEET_REGISTRY_TTL', str(6 * 3600)))  # секунд
+sheet_registry = SpreadsheetRegistry(ttl=SHEET_REGISTRY_TTL)
 
 # Проверка наличия файла с учетными данными
 def get_google_creds():
@@ -61,74 +89,533 @@ def get_google_creds():
 creds = get_google_creds()
 SERVICE_ACCOUNT_EMAIL = creds.service_account_email
 client = gspread.authorize(creds)
+sheet_changes = SheetChangeDetector(client)  # ручные правки таблиц через Drive modifiedTime
 
 # Глобальные переменные для хранения состояния
-user_sheets = {}  # {user_id: {'url': str, 'id': str}}
-user_tasks = {}   # {user_id: {'start_time': datetime, 'description': str, 'tags': str}}
+user_sheets = {}  # {user_id: {'url': str, 'id': str, 'worksheet_id': int, 'worksheet_title': str}}
+# Пороги простоя таймеров: напоминание и автозакрытие
+TIMER_REMIND_HOURS = float(os.getenv('TIMER_REMIND_HOURS', '3'))
+TIMER_STALE_HOURS = float(os.getenv('TIMER_STALE_HOURS', '12'))
+IDLE_SWEEP_INTERVAL = 60  # секунд между проверками
+
+user_tasks = TimerRegistry(  # запущенные таймеры: по user_id и по id таймера
+    remind_after=TIMER_REMIND_HOURS * 3600,
+    stale_after=TIMER_STALE_HOURS * 3600
+)
+
+# Командный отчет: кто может его запрашивать и сколько таблиц читать одновременно
+TEAM_REPORT_ADMINS = {int(x) for x in os.getenv('TEAM_REPORT_ADMINS', '').split(',') if x.strip()}
+TEAM_REPORT_CONCURRENCY = int(os.getenv('TEAM_REPORT_CONCURRENCY', '8'))
+ROLLUP_TTL = int(os.getenv('ROLLUP_TTL', '600'))  # секунд
+
+rollup_cache = RollupCache(ttl=ROLLUP_TTL)  # дневные свертки вкладок для командного отчета
+report_cache = ReportCache()  # готовые тексты отчетов до следующей записи во вкладку
+SHEET_POLL_INTERVAL = int(os.getenv('SHEET_POLL_INTERVAL', '120'))  # секунд между проверками правок
+
+# Архив: строки старше горизонта переносятся в годовые вкладки, чтобы рабочая оставалась маленькой.
+# Горизонт не меньше месяца, чтобы недельные и дневные отчеты архив не читали.
+ARCHIVE_AFTER_DAYS = max(int(os.getenv('ARCHIVE_AFTER_DAYS', '365')), 31)
+ARCHIVE_INTERVAL = 24 * 3600  # секунд между проходами
+ARCHIVE_ENABLED = os.getenv('ARCHIVE_ENABLED', '1') == '1'  # при нескольких репликах — только на одной
+archive_rollups = {}  # {(ключ вкладки, год): дневная свертка архива} — архив меняет только сам бот
+sheet_locks = {}      # {ключ вкладки: threading.Lock} — вставка строк и архивация не идут одновременно
+# Между репликами то же обеспечивает блокировка в state_store (shared_sheet_lock):
+# архивация удаляет строки по номерам, и вставка другой реплики не должна их сдвинуть
+SHEET_LOCK_WAIT = 60          # секунд ждать занятую вкладку; запись задачи потом повторит журнал
+ARCHIVE_LOCK_TTL = 15 * 60    # секунд, дольше которых блокировку архивации упавшей реплики не держим
+WRITE_LOCK_TTL = 60
+
+def sheet_lock(sheet_key):
+    return sheet_locks.setdefault(sheet_key, threading.Lock())
+
+def shared_sheet_lock(sheet_key, ttl):
+    """Блокировка вкладки, общая для реплик (с одной репликой хватает sheet_lock)"""
+    return state_store.lock(f"sheet:{sheet_key[0]}:{sheet_key[1]}", ttl=ttl, wait=SHEET_LOCK_WAIT)
+
+def archive_cutoff():
+    """Строки с датой раньше этой лежат в архиве"""
+    return datetime.now(get_zone(DEFAULT_TIMEZONE)).date() - timedelta(days=ARCHIVE_AFTER_DAYS)
+
+# Графики рисуются в отдельных процессах; готовые картинки переиспользуются по file_id
+CHART_WORKERS = int(os.getenv('CHART_WORKERS', '1'))
+CHART_CACHE_SIZE = 500
+chart_executor = None  # создается при первом графике
+chart_cache = {}  # {(user_id, start_date, end_date, версия данных): file_id}
+sheet_versions = {}  # {ключ вкладки: версия данных} — растет при каждом сбросе кэшей вкладки
+
+# Время хранится в UTC, показывается и пишется в таблицу в поясе пользователя
+DEFAULT_TIMEZONE = os.getenv('DEFAULT_TIMEZONE', 'Europe/Moscow')
+user_timezones = {}  # {user_id: название пояса}
+
+@lru_cache(maxsize=None)
+def get_zone(name):
+    """Объект пояса по названию (кэшируется, чтобы не искать его при каждом переводе)"""
+    return pytz.timezone(name)
+
+def user_zone(user_id):
+    return get_zone(user_timezones.get(user_id, DEFAULT_TIMEZONE))
+
+def utc_now():
+    return datetime.now(pytz.utc)
+
+# Корректная остановка: сколько ждать незавершенные записи и куда сохранить остальное
+SHUTDOWN_DRAIN_SECONDS = float(os.getenv('SHUTDOWN_DRAIN_SECONDS', '20'))
+STATE_FILE = os.getenv('STATE_FILE', 'bot_state.json')
+STATE_FILE_INTERVAL = 10  # секунд между проверками состояния для файла (изменения вне обработчиков)
+state_file_lock = threading.Lock()  # записи файла идут в потоках: старый снимок не затирает новый
+state_file_versions = itertools.count(1)
+written_state = {'version': 0, 'text': None}  # последний записанный в STATE_FILE снимок
+pending_saves = {}  # {asyncio.Task: (user_id, строки)} — записи, которые еще идут
+# Состояния разговоров и user_data переживают перезапуск: построчно в SQLite
+PERSISTENCE_FILE = os.getenv('PERSISTENCE_FILE', 'bot_state.sqlite3')
+
+# Журнал завершенных задач: сначала на диск, потом в Google; недошедшие повторяются в фоне
+JOURNAL_FILE = os.getenv('JOURNAL_FILE', 'journal.jsonl')
+JOURNAL_RETRY_INTERVAL = 30  # секунд между проверками журнала
+journal = Journal(JOURNAL_FILE)
+# Все операции журнала по очереди в одном потоке: fsync не останавливает цикл событий.
+# Пул не закрываем при остановке: поставленные операции интерпретатор дождется при выходе
+journal_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='journal')
+
+async def in_journal(method, *args):
+    """Вызывает метод журнала в его потоке"""
+    return await asyncio.get_running_loop().run_in_executor(journal_executor, method, *args)
+
+tag_indexes = {}  # {user_id: TagIndex}
+
+# Исходящие запросы к Telegram: лимиты 30/с на бота и по чатам, рассылки — после ответов
+rate_limiter = PriorityRateLimiter()
+BULK = {'priority': PRIORITY_BULK}  # rate_limit_args для фоновых сообщений
+
+# Дайджесты по подписке: отправки размазаны по окну, чтобы не упираться в квоту Sheets
+DIGEST_CHECK_INTERVAL = 60  # секунд между проверками
+DIGEST_WINDOW = int(os.getenv('DIGEST_WINDOW', '1800'))  # секунд, на которые растягивается рассылка
+DIGEST_CONCURRENCY = int(os.getenv('DIGEST_CONCURRENCY', '2'))  # одновременных чтений таблиц
+user_digests = {}  # {user_id: DigestPreference}
+
+# Вебхук и служебные эндпоинты (/healthcheck — живость, /ready — готовность по кэшу проверок)
+WEBHOOK_BASE_URL = os.getenv('WEBHOOK_BASE_URL', 'https://kplusbot-timetrack.onrender.com')
+WEBHOOK_LISTEN = '0.0.0.0'
+WEBHOOK_PORT = int(os.getenv('PORT', '10000'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')  # не токен: путь виден в логах прокси
+# Telegram присылает секрет в заголовке. Он обязан быть общим для всех реплик и перезапусков:
+# случайный секрет каждого процесса перерегистрирует вебхук, и остальные отвечают 403 на все обновления
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+if not WEBHOOK_SECRET or not re.fullmatch(r'[A-Za-z0-9_-]{1,256}', WEBHOOK_SECRET):
+    raise ValueError("WEBHOOK_SECRET не задан или некорректен (1-256 символов A-Z, a-z, 0-9, _ и -)")
+# 1 — только за прокси (Render): IP для лимита берется из X-Forwarded-For, который без прокси подделывается
+WEBHOOK_TRUST_PROXY = os.getenv('WEBHOOK_TRUST_PROXY', '0') == '1'
+READY_PROBE_INTERVAL = int(os.getenv('READY_PROBE_INTERVAL', '60'))  # секунд между проверками
+DRIVE_ABOUT_URL = 'https://www.googleapis.com/drive/v3/about'
+health_probes = HealthProbes(max_age=READY_PROBE_INTERVAL * 3)
+update_dedupe = UpdateDeduplicator()  # повторные доставки вебхука при медленном ответе
+
+# Состояние пользователей (таблица, пояс, дайджест, таймеры, теги, шаг диалога) в хранилище,
+# общем для реплик: memory — одна реплика, redis — несколько за одним вебхуком
+STATE_BACKEND = os.getenv('STATE_BACKEND', 'memory')
+state_store = create_state_store(STATE_BACKEND, os.getenv('REDIS_URL'))
+STATE_CLAIM_RETRIES = 3
+user_versions = {}  # {user_id: версия состояния, которую видела эта реплика}
+saved_states = {}   # {user_id: последнее записанное состояние} — чтобы не писать без изменений
+conversation_handlers = []  # диалоги приложения (build_application); их шаги тоже в общем состоянии
+
+def conversation_key(user_id):
+    """Ключ разговора PTB (chat_id, user_id): бот работает в личных чатах, где они совпадают"""
+    return (user_id, user_id)
+
+def export_conversations(user_id):
+    """Шаги диалогов пользователя: {название диалога: состояние}"""
+    key = conversation_key(user_id)
+    states = {}
+    for handler in conversation_handlers:
+        # Публичного доступа к шагам у PTB нет; persistence PTB работает с тем же словарем
+        state = handler._conversations.get(key)
+        if isinstance(state, int):
+            states[handler.name] = state
+    return states
+
+def apply_conversations(user_id, states):
+    """Переносит шаги диалогов из общего состояния: PTB читает persistence только при запуске"""
+    key = conversation_key(user_id)
+    for handler in conversation_handlers:
+        state = states.get(handler.name)
+        if state is None:
+            handler._conversations.pop(key, None)
+        else:
+            handler._conversations[key] = state
+
+def export_user_state(user_id):
+    """Состояние пользователя из локальных структур для записи в хранилище"""
+    preference = user_digests.get(user_id)
+    sheet_info = user_sheets.get(user_id)
+    return {
+        # Копия: локальный словарь меняется на месте, а с записанным надо сравнивать
+        'sheet': dict(sheet_info) if sheet_info else None,
+        'timezone': user_timezones.get(user_id),
+        'digest': preference.to_dict() if preference else None,
+        'timers': [timer.to_dict() for timer in user_tasks.running(user_id)],
+        'current': user_tasks.current_id(user_id),
+        'tags': tag_indexes[user_id].to_dict() if user_id in tag_indexes else None,
+        'conversations': export_conversations(user_id),
+    }
 
-async def handle_webhook_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await application.process_update(update)
+def apply_user_state(user_id, state):
+    """Переносит состояние из хранилища в локальные структуры"""
+    if state['sheet'] is None:
+        user_sheets.pop(user_id, None)
+    else:
+        user_sheets[user_id] = dict(state['sheet'])
+    if state['timezone'] is None:
+        user_timezones.pop(user_id, None)
+    else:
+        user_timezones[user_id] = state['timezone']
+    if state['digest'] is None:
+        user_digests.pop(user_id, None)
+    else:
+        user_digests[user_id] = digests.DigestPreference.from_dict(state['digest'])
+    user_tasks.replace_user(user_id, state['timers'], state.get('current'))
+    if state.get('tags') is None:
+        tag_indexes.pop(user_id, None)
+    else:
+        tag_indexes[user_id] = TagIndex.from_dict(state['tags'])
+    apply_conversations(user_id, state.get('conversations') or {})
+
+async def load_user_state(user_id):
+    """Подтягивает состояние пользователя, если его изменила другая реплика"""
+    version, state = await state_store.load(user_id)
+    if version == user_versions.get(user_id, 0):
+        return
+    if state is not None:
+        apply_user_state(user_id, state)
+    user_versions[user_id] = version
+    saved_states[user_id] = state
+
+async def save_user_state(user_id):
+    """Записывает изменившееся состояние; StaleStateError, если другая реплика успела раньше"""
+    state = export_user_state(user_id)
+    if state == saved_states.get(user_id):
+        return
+    user_versions[user_id] = await state_store.save(user_id, user_versions.get(user_id, 0), state)
+    saved_states[user_id] = state
+
+async def claim_timer(user_id, timer_id):
+    """Снимает таймер с учета во всех репликах и возвращает его
+
+    None — таймер уже завершила другая реплика (или сам пользователь).
+    """
+    for _ in range(STATE_CLAIM_RETRIES):
+        timer = user_tasks.remove(user_id, timer_id)
+        if timer is None:
+            return None
+        try:
+            await save_user_state(user_id)
+            return timer
+        except StaleStateError:
+            # Берем свежую версию: если таймер там остался, пробуем снова
+            await load_user_state(user_id)
+    logger.warning(f"Не удалось закрепить завершение таймера #{timer_id} пользователя {user_id}")
+    return None
+
+async def sync_user_state_in(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """До обработчиков: свежее состояние пользователя из хранилища"""
+    if update.effective_user:
+        await load_user_state(update.effective_user.id)
+
+async def sync_user_state_out(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """После обработчиков: изменения пользователя в хранилище"""
+    if not update.effective_user:
+        return
+    user_id = update.effective_user.id
+    try:
+        await save_user_state(user_id)
+    except StaleStateError:
+        logger.warning(f"Состояние {user_id} одновременно изменила другая реплика, берем ее версию")
+        await load_user_state(user_id)
+    await save_state_file()
+
+def get_tag_index(user_id):
+    """Словарь тегов пользователя"""
+    if user_id not in tag_indexes:
+        tag_indexes[user_id] = TagIndex()
+    return tag_indexes[user_id]
 
 async def start_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()  # Обязательно для callback-кнопок
     logger.info(f"Получен callback: {query.data} от {query.from_user.id}")
 
     # Редактируем сообщение с кнопкой
-    await query.edit_message_text(
-        text="🚀 Бот запущен! Выберите действие:",
-        reply_markup=get_main_keyboard()  # Ваша клавиатура с кнопками
-    )
+    await respond(update, "🚀 Бот запущен! Выберите действие:", get_main_keyboard())
+
+SPREADSHEET_ID_PATTERNS = tuple(re.compile(pattern) for pattern in [
+    r'/spreadsheets/d/([a-zA-Z0-9-_]+)',
+    r'/d/([a-zA-Z0-9-_]+)',
+    r'^([a-zA-Z0-9-_]+)$'
+])
 
+@lru_cache(maxsize=1024)
 def extract_spreadsheet_id(url):
     """Извлекает ID таблицы из различных форматов URL"""
-    patterns = [
-        r'/spreadsheets/d/([a-zA-Z0-9-_]+)',
-        r'/d/([a-zA-Z0-9-_]+)',
-        r'^([a-zA-Z0-9-_]+)$'
-    ]
-    
-    for pattern in patterns:
-        match = re.search(pattern, url)
+    for pattern in SPREADSHEET_ID_PATTERNS:
+        match = pattern.search(url)
         if match:
             return match.group(1)
     
     return None
 
+REQUIRED_HEADERS = ['Дата', 'Начало', 'Конец', 'Часы', 'Задача', 'Теги', 'Интервалы']
+
+# Символы, запрещённые в названиях вкладок Google Sheets
+WORKSHEET_TITLE_FORBIDDEN = re.compile(r'[\[\]*?:/\\]')
+
+def worksheet_title_for(user, project=None):
+    """Возвращает название вкладки для пользователя или проекта"""
+    if project:
+        title = project
+    else:
+        title = f"{user.full_name} ({user.id})"
+    return WORKSHEET_TITLE_FORBIDDEN.sub('', title).strip()[:100]
+
+def get_or_create_worksheet(spreadsheet, title, user_id=None):
+    """Находит вкладку пользователя/проекта или создаёт её, обновляя реестр таблиц"""
+    worksheets = spreadsheet.worksheets()
+    info = sheet_registry.update(
+        spreadsheet.id, spreadsheet.title, [(worksheet.id, worksheet.title) for worksheet in worksheets]
+    )
+    # Вкладку пользователя ищем по id в конце названия, чтобы смена имени не плодила вкладки
+    worksheet_id = sheet_registry.find_worksheet(info, title, user_id)
+    if worksheet_id is not None:
+        return next(worksheet for worksheet in worksheets if worksheet.id == worksheet_id)
+
+    try:
+        worksheet = spreadsheet.add_worksheet(title=title, rows=1000, cols=len(REQUIRED_HEADERS))
+    except gspread.exceptions.APIError:
+        # Вкладку мог одновременно создать другой участник проекта
+        worksheet = spreadsheet.worksheet(title)
+    sheet_registry.add_worksheet(spreadsheet.id, worksheet.id, worksheet.title)
+    return worksheet
+
+def ensure_headers(worksheet):
+    """Проверяет заголовки вкладки, дописывает недостающие и возвращает их список"""
+    headers = worksheet.row_values(1)
+    
+    if not any(header in headers for header in REQUIRED_HEADERS):
+        # Если заголовков нет - создаем их
+        worksheet.insert_row(REQUIRED_HEADERS, index=1)
+        return list(REQUIRED_HEADERS)
+    
+    missing = [header for header in REQUIRED_HEADERS if header not in headers]
+    if missing:
+        # Старые таблицы: новые колонки добавляем справа, не трогая существующие
+        if worksheet.col_count < len(headers) + len(missing):
+            worksheet.add_cols(len(headers) + len(missing) - worksheet.col_count)
+        worksheet.update(gspread.utils.rowcol_to_a1(1, len(headers) + 1), [missing])
+        headers = headers + missing
+    return headers
+
+def get_sheet_headers(user_id, worksheet):
+    """Заголовки вкладки пользователя (из реестра таблиц)"""
+    spreadsheet_id = user_sheets[user_id]['id']
+    headers = sheet_registry.headers(spreadsheet_id, worksheet.id)
+    if headers is None:
+        headers = ensure_headers(worksheet)
+        sheet_registry.set_headers(spreadsheet_id, worksheet.id, headers)
+    return headers
+
+def bind_user_sheet(user_id, spreadsheet_id, worksheet_id, worksheet_title):
+    """Привязывает вкладку к пользователю и возвращает ссылку на нее"""
+    spreadsheet_url = f"https://docs.google.com/spreadsheets/d/{spreadsheet_id}"
+    user_sheets[user_id] = {
+        'url': spreadsheet_url,
+        'id': spreadsheet_id,
+        'worksheet_id': worksheet_id,
+        'worksheet_title': worksheet_title
+    }
+    return f"{spreadsheet_url}#gid={worksheet_id}"
+
+def open_worksheet(spreadsheet_id, worksheet_id):
+    """Открывает вкладку таблицы по id (None — первая вкладка)"""
+    spreadsheet = client.open_by_key(spreadsheet_id)
+    if worksheet_id is None:
+        return spreadsheet.sheet1
+    return spreadsheet.get_worksheet_by_id(worksheet_id)
+
+def open_user_worksheet(user_id):
+    """Открывает вкладку, привязанную к пользователю"""
+    sheet_info = user_sheets[user_id]
+    return open_worksheet(sheet_info['id'], sheet_info.get('worksheet_id'))
+
+def user_sheet_key(user_id):
+    """Ключ вкладки пользователя для кэшей"""
+    sheet_info = user_sheets[user_id]
+    return (sheet_info['id'], sheet_info.get('worksheet_id'))
+
+def invalidate_sheet(sheet_key):
+    """Сбрасывает все кэши, построенные по данным вкладки"""
+    rollup_cache.invalidate(sheet_key)
+    report_cache.invalidate(sheet_key)
+    sheet_versions[sheet_key] = sheet_versions.get(sheet_key, 0) + 1
+
+def invalidate_spreadsheet(spreadsheet_id):
+    """Сбрасывает кэши всех подключенных вкладок таблицы"""
+    for sheet_info in list(user_sheets.values()):
+        if sheet_info['id'] == spreadsheet_id:
+            invalidate_sheet((sheet_info['id'], sheet_info.get('worksheet_id')))
+
+def read_records(worksheet):
+    """Строки вкладки неформатированными: часы — числа, даты — серийные номера"""
+    return records_from_values(worksheet.get_all_values(**UNFORMATTED_READ))
+
+def fetch_sheet_records(spreadsheet_id, worksheet_id):
+    """Читает все строки вкладки (блокирующий вызов, запускать в потоке)"""
+    return read_records(open_worksheet(spreadsheet_id, worksheet_id))
+
+def fetch_period_records(spreadsheet_id, worksheet_id, start_date, end_date):
+    """Строки вкладки для отчета за период; архивы читаются, только если период в них заходит
+
+    Блокирующий вызов, запускать в потоке.
+    """
+    worksheet = open_worksheet(spreadsheet_id, worksheet_id)
+    records = read_records(worksheet)
+    cutoff = archive_cutoff()
+    if start_date < cutoff:
+        for year in range(start_date.year, min(end_date, cutoff).year + 1):
+            archived = archive.open_archive(worksheet.spreadsheet, worksheet.id, year)
+            if archived is not None:
+                records.extend(read_records(archived))
+    return records
+
+def load_archive_rollup(sheet_key, year):
+    """Дневная свертка годового архива вкладки (читается заново после архивации в этот архив)"""
+    rollup = archive_rollups.get((sheet_key, year))
+    if rollup is None:
+        worksheet = open_worksheet(*sheet_key)
+        archived = archive.open_archive(worksheet.spreadsheet, worksheet.id, year)
+        rollup = build_daily_rollup(read_records(archived)) if archived is not None else {}
+        archive_rollups[(sheet_key, year)] = rollup
+    return rollup
+
+def archive_sheet(sheet_key, cutoff):
+    """Архивирует одну вкладку; возвращает число перенесенных строк
+
+    Свертки измененных архивов перечитываются при следующем отчете, а не дополняются:
+    перенесенные строки могли попасть в архив еще прошлым, прерванным проходом.
+    """
+    worksheet = open_worksheet(*sheet_key)
+    by_year = None
+    try:
+        with sheet_lock(sheet_key):
+            _, by_year = archive.archive_rows(worksheet.spreadsheet, worksheet, cutoff)
+    finally:
+        for key in list(archive_rollups):
+            # Проход прервался — неизвестно, какие архивы он успел дописать
+            if key[0] == sheet_key and (by_year is None or key[1] in by_year):
+                del archive_rollups[key]
+    if any(by_year.values()):
+        invalidate_sheet(sheet_key)
+    return sum(len(rows) for rows in by_year.values())
+
 def get_main_keyboard():
     """Возвращает основную клавиатуру"""
     keyboard = [
         [InlineKeyboardButton("Начать задачу", callback_data='task_start')],
         [InlineKeyboardButton("Закончить задачу", callback_data='task_end')],
+        [InlineKeyboardButton("Мои таймеры", callback_data='timers')],
         [InlineKeyboardButton("Отчет за неделю", callback_data='report_week')]
     ]
     return InlineKeyboardMarkup(keyboard)
 
-async def edit_message_without_reply_markup(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
-    """Редактирует сообщение, убирая клавиатуру"""
-    if hasattr(update, 'callback_query'):
-        await update.callback_query.edit_message_text(
-            text=text,
-            reply_markup=None
-        )
-    else:
-        await update.message.reply_text(text)
+def get_timers_keyboard(timers, zone):
+    """Возвращает клавиатуру со списком запущенных таймеров"""
+    keyboard = [
+        [
+            InlineKeyboardButton(f"⏹ {timer.label(zone)}", callback_data=f'timer_end:{timer.id}'),
+            InlineKeyboardButton("▶️" if timer.paused else "⏸",
+                                 callback_data=f"timer_{'resume' if timer.paused else 'pause'}:{timer.id}")
+        ]
+        for timer in timers
+    ]
+    keyboard.append([InlineKeyboardButton("Назад", callback_data='start')])
+    return InlineKeyboardMarkup(keyboard)
+
+def get_tags_keyboard(user_id, timer):
+    """Клавиатура с недавними тегами пользователя; выбранные отмечены галочкой"""
+    tag_index = get_tag_index(user_id)
+    selected = set(tag_index.ids_for(timer.tags or ''))
+    buttons = [
+        InlineKeyboardButton(f"{'✅ ' if tag_id in selected else ''}{name}", callback_data=f'tag:{tag_id}')
+        for tag_id, name in tag_index.recent()
+    ]
+    keyboard = [buttons[i:i + 2] for i in range(0, len(buttons), 2)]
+    if selected:
+        keyboard.append([InlineKeyboardButton("Готово", callback_data='tags_done')])
+    keyboard.append([InlineKeyboardButton("Пропустить", callback_data='skip_tags')])
+    return InlineKeyboardMarkup(keyboard)
+
+def get_confirm_end_keyboard():
+    """Клавиатура подтверждения завершения задачи"""
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("Да, завершить", callback_data='confirm_end')],
+        [InlineKeyboardButton("Отмена", callback_data='cancel_end')]
+    ])
+
+async def respond(update: Update, text=None, reply_markup=None, alert=None, answered=False):
+    """Отвечает на обновление минимальным числом запросов к Telegram
+
+    На нажатие кнопки — один answer (с всплывающим alert, если он задан) и одна
+    правка того же сообщения, несущая и текст, и клавиатуру. На сообщение — один ответ.
+    """
+    query = update.callback_query
+    if query is None:
+        await update.message.reply_text(text or alert, reply_markup=reply_markup)
+        return
+    
+    if not answered:
+        await query.answer(alert, show_alert=alert is not None)
+    if text is None:
+        return
+    try:
+        await query.edit_message_text(text, reply_markup=reply_markup)
+    except BadRequest as e:
+        # Повторное нажатие: сообщение уже в нужном виде
+        if 'not modified' not in str(e):
+            raise
 
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Обработчик /start: показывает меню и ждет ссылку на таблицу"""
     user = update.effective_user
     logger.info(f"⚡ Команда /start от {user.id} ({user.full_name})")
     
+    sheet_info = user_sheets.get(user.id)
+    if sheet_info:
+        sheet_text = (
+            f"📑 Подключена вкладка: {sheet_info.get('worksheet_title') or sheet_info['id']}\n"
+            "Чтобы подключить другую таблицу, пришлите ссылку на нее."
+        )
+    else:
+        sheet_text = (
+            "🔗 Пришлите ссылку на Google таблицу (после нее через пробел можно указать проект).\n"
+            f"Дайте доступ редактора для {SERVICE_ACCOUNT_EMAIL}"
+        )
+    
     await update.message.reply_text(
         "🔄 Бот активирован!\n"
+        f"{sheet_text}\n\n"
         "Для работы с задачами используйте меню:",
         reply_markup=get_main_keyboard()
     )
+    return START
+
+async def cancel_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Отмена подключения таблицы (запущенные таймеры не трогает)"""
+    await update.message.reply_text("Действие отменено.", reply_markup=get_main_keyboard())
+    return ConversationHandler.END
     
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Обработчик отмены действий"""
     user_id = update.effective_user.id
-    if user_id in user_tasks:
-        del user_tasks[user_id]
+    timer = user_tasks.current(user_id)
+    if timer:
+        user_tasks.remove(user_id, timer.id)
     
     await update.message.reply_text(
         "Действие отменено.",
@@ -136,46 +623,122 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     )
     return ConversationHandler.END
 
+async def set_timezone(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Обработчик команды /timezone: показывает или меняет часовой пояс"""
+    user_id = update.effective_user.id
+    if not context.args:
+        await update.message.reply_text(
+            f"🕒 Ваш часовой пояс: {user_zone(user_id).zone}\n"
+            "Изменить: /timezone Europe/Moscow"
+        )
+        return
+    
+    try:
+        zone = get_zone(context.args[0])
+    except pytz.exceptions.UnknownTimeZoneError:
+        await update.message.reply_text(
+            "❌ Неизвестный часовой пояс. Пример: Europe/Moscow, Asia/Yekaterinburg"
+        )
+        return
+    
+    user_timezones[user_id] = zone.zone
+    await update.message.reply_text(
+        f"✅ Часовой пояс: {zone.zone}, сейчас {datetime.now(zone).strftime('%H:%M')}",
+        reply_markup=get_main_keyboard()
+    )
+
+async def set_digest(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Обработчик команды /digest: подписка на регулярный отчет"""
+    user_id = update.effective_user.id
+    usage = (
+        "Изменить: /digest weekly пт 18:00, /digest daily 19:00 или /digest off\n"
+        "Время — по вашему часовому поясу (/timezone)"
+    )
+    if not context.args:
+        preference = user_digests.get(user_id)
+        status = f"📬 Дайджест: {preference.describe()}" if preference else "📭 Дайджест отключен"
+        await update.message.reply_text(f"{status}\n{usage}")
+        return
+    
+    if context.args[0].lower() == 'off':
+        user_digests.pop(user_id, None)
+        await update.message.reply_text("📭 Дайджест отключен", reply_markup=get_main_keyboard())
+        return
+    
+    if user_id not in user_sheets:
+        await update.message.reply_text("Сначала подключите Google таблицу через /start")
+        return
+    
+    try:
+        preference = digests.parse_digest_args(context.args)
+    except ValueError as e:
+        await update.message.reply_text(f"❌ {e}\n{usage}")
+        return
+    
+    # Если сегодняшнее время уже прошло, первый дайджест придет в следующий раз
+    local_now = datetime.now(user_zone(user_id))
+    if digests.is_due(preference, user_id, local_now, DIGEST_WINDOW):
+        preference.last_sent = local_now.date().isoformat()
+    user_digests[user_id] = preference
+    await update.message.reply_text(
+        f"📬 Дайджест: {preference.describe()}",
+        reply_markup=get_main_keyboard()
+    )
+
 async def handle_spreadsheet_url(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Обработчик ссылки/ID таблицы"""
-    user_id = update.effective_user.id
+    user = update.effective_user
+    user_id = user.id
     user_input = update.message.text.strip()
     
     try:
+        # Всё, что после ссылки, — название вкладки проекта (по умолчанию вкладка пользователя)
+        link, _, project = user_input.partition(' ')
+        project = project.strip() or None
+
         # Извлекаем ID таблицы
-        spreadsheet_id = extract_spreadsheet_id(user_input)
+        spreadsheet_id = extract_spreadsheet_id(link)
         if not spreadsheet_id:
             await update.message.reply_text(
                 "❌ Не могу извлечь ID таблицы из вашей ссылки."
             )
             return START
 
+        title = worksheet_title_for(user, project)
+        title_owner = None if project else user_id
+        
+        # Таблица уже проверена для другого участника, и вкладка готова — отвечаем без API
+        info = sheet_registry.get(spreadsheet_id)
+        worksheet_id = info and sheet_registry.find_worksheet(info, title, title_owner)
+        if worksheet_id is not None and sheet_registry.headers(spreadsheet_id, worksheet_id) is not None:
+            link = bind_user_sheet(user_id, spreadsheet_id, worksheet_id, info.worksheets[worksheet_id])
+            await update.message.reply_text(
+                f"✅ Успешно подключено к таблице: {info.title}\n"
+                f"📑 Вкладка: {info.worksheets[worksheet_id]}\n"
+                f"🔗 {link}\n\n"
+                "Теперь вы можете начать работу с задачами!",
+                reply_markup=get_main_keyboard()
+            )
+            return ConversationHandler.END
+        
         await update.message.reply_text("🔄 Проверяю доступ к таблице...")
         
         try:
             # Пробуем открыть таблицу
             spreadsheet = client.open_by_key(spreadsheet_id)
-            worksheet = spreadsheet.sheet1
+            worksheet = get_or_create_worksheet(spreadsheet, title, user_id=title_owner)
             
-            # Проверяем, инициализирована ли уже таблица
-            if spreadsheet_id not in initialized_sheets:
-                headers = worksheet.row_values(1)
-                required_headers = ['Дата', 'Начало', 'Конец', 'Часы', 'Задача', 'Теги']
-                
-                if not all(header in headers for header in required_headers):
-                    # Если заголовков нет - создаем их
-                    worksheet.insert_row(required_headers, index=1)
-                    initialized_sheets[spreadsheet_id] = True
-                else:
-                    initialized_sheets[spreadsheet_id] = True
+            # Проверяем, инициализирована ли уже вкладка
+            if sheet_registry.headers(spreadsheet_id, worksheet.id) is None:
+                sheet_registry.set_headers(spreadsheet_id, worksheet.id, ensure_headers(worksheet))
             
             # Если дошли сюда - доступ есть
-            spreadsheet_url = f"https://docs.google.com/spreadsheets/d/{spreadsheet_id}"
-            user_sheets[user_id] = {'url': spreadsheet_url, 'id': spreadsheet_id}
+            link = bind_user_sheet(user_id, spreadsheet_id, worksheet.id, worksheet.title)
             
             await update.message.reply_text(
                 f"✅ Успешно подключено к таблице: {spreadsheet.title}\n"
-                f"🔗 {spreadsheet_url}\n\n"
+                f"📑 Вкладка: {worksheet.title}\n"
+                f"🔗 {link}\n\n"
                 "Теперь вы можете начать работу с задачами!",
                 reply_markup=get_main_keyboard()
             )
@@ -183,6 +746,7 @@ async def handle_spreadsheet_url(update: Update, context: ContextTypes.DEFAULT_T
             
         except gspread.exceptions.APIError as e:
             if "PERMISSION_DENIED" in str(e):
+                sheet_registry.mark_denied(spreadsheet_id)
                 await update.message.reply_text(
                     "🔐 Нет доступа к таблице. Необходимо:\n"
                     f"1. Откройте настройки доступа таблицы\n"
@@ -203,32 +767,19 @@ async def handle_spreadsheet_url(update: Update, context: ContextTypes.DEFAULT_T
 
 async def task_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Обработчик начала задачи"""
-    query = update.callback_query
-    await query.answer()
-    
-    # Убираем кнопки из предыдущего сообщения
-    await query.edit_message_reply_markup(reply_markup=None)
-    
     user_id = update.effective_user.id
     if user_id not in user_sheets:
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id,
-            text="Сначала подключите Google таблицу через /start"
-        )
+        await respond(update, "Сначала подключите Google таблицу через /start")
         return ConversationHandler.END
     
-    now = datetime.now()
-    user_tasks[user_id] = {
-        'start_time': now,
-        'description': None,
-        'tags': None
-    }
+    now = utc_now()
+    timer = user_tasks.start(user_id, now, await state_store.next_id('timer'))
     
-    # Отправляем новое сообщение
-    await context.bot.send_message(
-        chat_id=update.effective_chat.id,
-        text=f"⏱️ Задача начата в {now.strftime('%H:%M:%S')}\n"
-             "Введите описание задачи:"
+    # Меню заменяется текстом задачи одной правкой, без отдельного сообщения
+    await respond(
+        update,
+        f"⏱️ Задача #{timer.id} начата в {now.astimezone(user_zone(user_id)).strftime('%H:%M:%S')}\n"
+        "Введите описание задачи:"
     )
     return TASK_DESCRIPTION
 
@@ -238,15 +789,17 @@ async def handle_task_description(update: Update, context: ContextTypes.DEFAULT_
     user_id = update.effective_user.id
     description = update.message.text
     
-    if user_id not in user_tasks:
+    timer = user_tasks.current(user_id)
+    if not timer:
         await update.message.reply_text("❌ Нет активной задачи. Начните новую через /taskstart")
         return ConversationHandler.END
     
-    user_tasks[user_id]['description'] = description
+    timer.description = description
     
     await update.message.reply_text(
-        "📝 Описание сохранено. Теперь введите теги через запятую:\n"
-        "Пример: СОВхОС, интервью, логи, аналитика"
+        "📝 Описание сохранено. Теперь введите теги через запятую или выберите из недавних:\n"
+        "Пример: СОВхОС, интервью, логи, аналитика",
+        reply_markup=get_tags_keyboard(user_id, timer)
     )
     return TASK_TAGS
 
@@ -256,19 +809,63 @@ async def handle_task_tags(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     user_id = update.effective_user.id
     tags = update.message.text
     
-    if user_id not in user_tasks:
+    timer = user_tasks.current(user_id)
+    if not timer:
         await update.message.reply_text("❌ Нет активной задачи")
         return ConversationHandler.END
     
-    user_tasks[user_id]['tags'] = tags
+    # Введенные теги добавляются к выбранным кнопками и сразу приводятся к каноническому виду
+    timer.tags = get_tag_index(user_id).canonical(f"{timer.tags or ''},{tags}")
     
     # Сохраняем сообщение с кнопками подтверждения
     await update.message.reply_text(
-        "Теги сохранены. Завершить задачу?",
-        reply_markup=InlineKeyboardMarkup([
-            [InlineKeyboardButton("Да, завершить", callback_data='confirm_end')],
-            [InlineKeyboardButton("Отмена", callback_data='cancel_end')]
-        ])
+        f"Теги сохранены: {timer.tags}. Завершить задачу?",
+        reply_markup=get_confirm_end_keyboard()
+    )
+    return TASK_TAGS
+
+async def toggle_tag(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Выбор/снятие тега кнопкой из недавних"""
+    query = update.callback_query
+    await query.answer()
+    
+    user_id = update.effective_user.id
+    timer = user_tasks.current(user_id)
+    if not timer:
+        await query.edit_message_text("❌ Нет активной задачи", reply_markup=get_main_keyboard())
+        return ConversationHandler.END
+    
+    tag_index = get_tag_index(user_id)
+    tag_id = int(query.data.split(':', 1)[1])
+    selected = list(tag_index.ids_for(timer.tags or ''))
+    # Неизвестный id — кнопка из старого сообщения: только перерисуем клавиатуру
+    if tag_index.known(tag_id):
+        if tag_id in selected:
+            selected.remove(tag_id)
+        else:
+            selected.append(tag_id)
+    timer.tags = ', '.join(tag_index.name(selected_id) for selected_id in selected)
+    
+    await query.edit_message_text(
+        f"🏷 Выбрано: {timer.tags or 'ничего'}\n"
+        "Выберите еще или введите теги через запятую:",
+        reply_markup=get_tags_keyboard(user_id, timer)
+    )
+    return TASK_TAGS
+
+async def tags_done(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Завершение выбора тегов кнопками"""
+    query = update.callback_query
+    await query.answer()
+    
+    timer = user_tasks.current(update.effective_user.id)
+    if not timer:
+        await query.edit_message_text("❌ Нет активной задачи", reply_markup=get_main_keyboard())
+        return ConversationHandler.END
+    
+    await query.edit_message_text(
+        f"Теги сохранены: {timer.tags}. Завершить задачу?",
+        reply_markup=get_confirm_end_keyboard()
     )
     return TASK_TAGS
 
@@ -277,39 +874,51 @@ async def save_task_with_tags(update: Update, context: ContextTypes.DEFAULT_TYPE
     user_id = update.effective_user.id
     tags = update.message.text
     
-    if user_id not in user_tasks:
+    timer = user_tasks.current(user_id)
+    if not timer:
         await update.message.reply_text("Нет активной задачи. Начните новую через /taskstart")
         return ConversationHandler.END
     
-    user_tasks[user_id]['tags'] = tags
+    timer.tags = tags
     return await end_task(update, context)
 
 async def task_end(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Обработчик кнопки завершения задачи"""
+    user_id = update.effective_user.id
+    timers = user_tasks.running(user_id)
+    
+    if not timers:
+        await respond(update, "ℹ️ Нет активной задачи для завершения", get_main_keyboard())
+        return ConversationHandler.END
+    
+    if len(timers) > 1:
+        # Несколько таймеров — даём выбрать, какой завершить
+        await respond(update, "Какую задачу завершить?", get_timers_keyboard(timers, user_zone(user_id)))
+        return ConversationHandler.END
+    
+    user_tasks.set_current(user_id, timers[0].id)
+    return await finish_timer(update, context, timers[0])
+
+async def timer_selected(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Обработчик выбора таймера для завершения"""
     query = update.callback_query
-    await query.answer()
     
     user_id = update.effective_user.id
-    
-    if user_id not in user_tasks:
-        # 1. Убираем кнопки в исходном сообщении (текст остается)
-        await query.edit_message_reply_markup(reply_markup=None)
-        
-        # 2. Отправляем новое сообщение с кнопками главного меню
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id,
-            text="ℹ️ Нет активной задачи для завершения",
-            reply_markup=get_main_keyboard()  # Кнопки главного меню
-        )
+    timer = user_tasks.get(user_id, int(query.data.split(':', 1)[1]))
+    if not timer:
+        await respond(update, "ℹ️ Этот таймер уже завершен", get_main_keyboard())
         return ConversationHandler.END
     
-    # Остальная логика (если задача активна)
-    if user_tasks[user_id]['description'] and not user_tasks[user_id]['tags']:
-        await query.edit_message_text(
-            "Введите теги через запятую:",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("Пропустить", callback_data='skip_tags')]
-            ])
+    user_tasks.set_current(user_id, timer.id)
+    return await finish_timer(update, context, timer)
+
+async def finish_timer(update: Update, context: ContextTypes.DEFAULT_TYPE, timer) -> int:
+    """Запрашивает недостающие теги или сохраняет выбранный таймер"""
+    if timer.description and not timer.tags:
+        await respond(
+            update,
+            "Введите теги через запятую или выберите из недавних:",
+            get_tags_keyboard(update.effective_user.id, timer)
         )
         return TASK_TAGS
     
@@ -317,63 +926,134 @@ async def task_end(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     
 async def skip_tags(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Обработчик пропуска тегов"""
-    query = update.callback_query
-    await query.answer()
-    
     user_id = update.effective_user.id
-    if user_id in user_tasks:
-        user_tasks[user_id]['tags'] = ''
+    timer = user_tasks.current(user_id)
+    if timer:
+        timer.tags = ''
     
     return await end_task(update, context)
 
+def build_timer_rows(user_id, timer, now):
+    """Готовит строки таблицы для завершенного таймера, ничего не записывая"""
+    # Интервалы в поясе пользователя, разрезанные по полуночи: задача через полночь — строка на каждый день
+    days = split_by_day(timer.closed_intervals(now), user_zone(user_id))
+    
+    # Теги канонизируются при записи, чтобы отчеты не дробились на варианты написания
+    tags = get_tag_index(user_id).record(timer.tags or '')
+    
+    rows = []
+    for day, intervals in sorted(days.items(), reverse=True):
+        # Часы считаем по интервалам, паузы не входят
+        hours = round(sum((end - start).total_seconds() for start, end in intervals) / 3600, 2)
+        rows.append({
+            'Дата': day.strftime('%Y-%m-%d'),
+            'Начало': intervals[0][0].strftime('%H:%M:%S'),
+            'Конец': intervals[-1][1].strftime('%H:%M:%S'),
+            'Часы': hours,
+            'Задача': timer.description,
+            'Теги': tags,
+            'Интервалы': format_intervals(intervals)
+        })
+    return rows
+
+def write_rows(user_id, rows):
+    """Записывает строки во вкладку пользователя (блокирующий вызов, запускать в потоке)"""
+    worksheet = open_user_worksheet(user_id)
+    headers = get_sheet_headers(user_id, worksheet)
+    
+    # Новые строки сверху, самый поздний день первым; архивация в это время не удаляет строки по номерам
+    with sheet_lock(user_sheet_key(user_id)):
+        worksheet.insert_rows(
+            [sheet_row(headers, values) for values in rows], row=2, value_input_option='USER_ENTERED'
+        )
+    invalidate_sheet(user_sheet_key(user_id))
+
+async def write_rows_shared(user_id, rows):
+    """write_rows в потоке под блокировкой вкладки, общей для реплик"""
+    async with shared_sheet_lock(user_sheet_key(user_id), WRITE_LOCK_TTL):
+        await asyncio.to_thread(write_rows, user_id, rows)
+
+async def save_rows(user_id, rows):
+    """Записывает строки в потоке; запись учитывается, пока не завершится, чтобы ее дождаться при остановке"""
+    task = asyncio.ensure_future(write_rows_shared(user_id, rows))
+    pending_saves[task] = (user_id, rows)
+    task.add_done_callback(lambda done: pending_saves.pop(done, None))
+    # shield: отмена обработчика при остановке не должна обрывать запись
+    await asyncio.shield(task)
+    return rows
+
+async def commit_rows(user_id, rows):
+    """Заносит строки в журнал и пробует записать их в таблицу
+
+    Возвращает True, если строки уже в таблице; иначе их допишет фоновый повтор.
+    """
+    entry = await in_journal(journal.append, user_id, rows)
+    try:
+        await save_rows(user_id, rows)
+    except Exception as e:
+        logger.error(f"Запись задачи {entry.id} отложена: {e}", exc_info=True)
+        await in_journal(journal.mark_failed, entry, time.time())
+        return False
+    await in_journal(journal.mark_done, entry)
+    return True
+
+def format_deferred_message(rows):
+    """Текст для задачи, которая пока сохранена только в журнале"""
+    return (
+        "📥 Google Таблицы сейчас недоступны. Задача сохранена локально "
+        "и будет записана автоматически — я пришлю подтверждение.\n"
+        f"📝 Описание: {rows[0]['Задача']} ({sum(float(values['Часы']) for values in rows):g} ч)"
+    )
+
+def format_saved_message(rows):
+    """Текст подтверждения сохраненной задачи (строки build_timer_rows)"""
+    values = rows[0]
+    if len(rows) == 1:
+        message = (
+            f"✅ Задача сохранена в таблицу!\n"
+            f"📅 Дата: {values['Дата']}\n"
+            f"⏱ Время: {values['Начало']} - {values['Конец']} ({values['Часы']} ч)\n"
+            f"📝 Описание: {values['Задача']}"
+        )
+        if ';' in values['Интервалы']:
+            message += f"\n⏸ Интервалы: {values['Интервалы']}"
+    else:
+        message = f"✅ Задача сохранена в таблицу по дням ({len(rows)})!\n"
+        for day_values in reversed(rows):
+            message += f"📅 {day_values['Дата']}: {day_values['Интервалы']} ({day_values['Часы']} ч)\n"
+        message += f"📝 Описание: {values['Задача']}"
+    
+    if values['Теги']:
+        message += f"\n🏷 Теги: {values['Теги']}"
+    return message
+
 async def end_task(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Финальное сохранение задачи"""
     user_id = update.effective_user.id
+    timer = user_tasks.current(user_id)
     
-    if user_id not in user_tasks or not user_tasks[user_id]['description']:
-        if hasattr(update, 'callback_query'):
-            await update.callback_query.edit_message_text(
-                "❌ Нет данных для сохранения",
-                reply_markup=get_main_keyboard()
-            )
-        else:
-            await update.message.reply_text(
-                "❌ Нет данных для сохранения",
-                reply_markup=get_main_keyboard()
-            )
+    if not timer or not timer.description:
+        await respond(update, "❌ Нет данных для сохранения", get_main_keyboard())
         return ConversationHandler.END
     
-    task_data = user_tasks[user_id]
-    end_time = datetime.now()
-    start_time = task_data['start_time']
-    duration = end_time - start_time
-    hours = round(duration.total_seconds() / 3600, 2)
+    # Нажатие подтверждаем сразу: запись в Google может занять время
+    if update.callback_query:
+        await update.callback_query.answer()
+    
+    # Закрепляем завершение до записи: вторая реплика ту же задачу уже не запишет.
+    # Строки — из снятого таймера: после перезагрузки в нем паузы и описание другой реплики
+    timer = await claim_timer(user_id, timer.id)
+    if timer is None:
+        await respond(update, "ℹ️ Эта задача уже завершена", get_main_keyboard(), answered=True)
+        return ConversationHandler.END
     
+    # Строки готовим до записи: даже если Google не ответит, данные не пропадут
+    rows = build_timer_rows(user_id, timer, utc_now())
     try:
-        spreadsheet_id = user_sheets[user_id]['id']
-        spreadsheet = client.open_by_key(spreadsheet_id)
-        worksheet = spreadsheet.sheet1
-        
-        new_row = [
-            start_time.strftime('%Y-%m-%d'),
-            start_time.strftime('%H:%M:%S'),
-            end_time.strftime('%H:%M:%S'),
-            str(hours),
-            task_data['description'],
-            task_data.get('tags', '')
-        ]
-        
-        worksheet.insert_row(new_row, index=2)
-        
-        message = (
-            f"✅ Задача сохранена в таблицу!\n"
-            f"📅 Дата: {new_row[0]}\n"
-            f"⏱ Время: {new_row[1]} - {new_row[2]} ({hours} ч)\n"
-            f"📝 Описание: {new_row[4]}"
-        )
-        
-        if task_data.get('tags'):
-            message += f"\n🏷 Теги: {new_row[5]}"
+        if await commit_rows(user_id, rows):
+            message = format_saved_message(rows)
+        else:
+            message = format_deferred_message(rows)
             
     except Exception as e:
         logger.error(f"Ошибка сохранения: {e}", exc_info=True)
@@ -383,174 +1063,568 @@ async def end_task(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         )
         
     finally:
-        # Отправляем новое сообщение с результатом и кнопками
-        if hasattr(update, 'callback_query'):
-            await context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text=message,
-                reply_markup=get_main_keyboard()  # Добавляем кнопки главного меню
-            )
-            # Оставляем предыдущее сообщение нетронутым
-        else:
-            await update.message.reply_text(
-                message,
-                reply_markup=get_main_keyboard()  # Добавляем кнопки главного меню
-            )
-        
-        if user_id in user_tasks:
-            del user_tasks[user_id]
+        # Результат заменяет нажатое сообщение и возвращает кнопки главного меню
+        await respond(update, message, get_main_keyboard(), answered=True)
     
     return ConversationHandler.END
 
 async def confirm_end_task(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Подтверждение завершения задачи"""
     query = update.callback_query
-    await query.answer()
     
     if query.data == 'confirm_end':
-        # Редактируем сообщение с кнопками подтверждения
-        await query.edit_message_text(
-            query.message.text,  # Сохраняем оригинальный текст
-            reply_markup=None  # Убираем кнопки подтверждения
-        )
+        # Результат сохранения заменит текст сообщения с кнопками подтверждения
         return await end_task(update, context)
     else:
         # Возвращаемся в главное меню
-        await query.edit_message_text(
-            "Задача не завершена. Продолжайте работу!",
-            reply_markup=get_main_keyboard()
-        )
+        await respond(update, "Задача не завершена. Продолжайте работу!", get_main_keyboard())
         return ConversationHandler.END
 
-async def report_week(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Генерирует отчет за неделю"""
+async def show_timers(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Показывает список запущенных таймеров"""
+    user_id = update.effective_user.id
+    timers = user_tasks.running(user_id)
+    if not timers:
+        await respond(update, "ℹ️ Нет запущенных таймеров", get_main_keyboard())
+        return
+    
+    await respond(update, f"⏱ Запущено таймеров: {len(timers)}", get_timers_keyboard(timers, user_zone(user_id)))
+
+async def toggle_timer_pause(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Ставит таймер на паузу или продолжает его"""
     query = update.callback_query
-    await query.answer()
+    action, timer_id = query.data.split(':', 1)
+    
+    user_id = update.effective_user.id
+    timer = user_tasks.get(user_id, int(timer_id))
+    if not timer:
+        await query.answer("Этот таймер уже завершен", show_alert=True)
+    elif action == 'timer_pause':
+        user_tasks.pause(user_id, timer.id, utc_now())
+        await query.answer(f"⏸ Задача #{timer.id} на паузе")
+    else:
+        user_tasks.resume(user_id, timer.id, utc_now())
+        await query.answer(f"▶️ Задача #{timer.id} продолжена")
+    
+    timers = user_tasks.running(user_id)
+    await query.edit_message_text(
+        f"⏱ Запущено таймеров: {len(timers)}" if timers else "ℹ️ Нет запущенных таймеров",
+        reply_markup=get_timers_keyboard(timers, user_zone(user_id)) if timers else get_main_keyboard()
+    )
+
+async def sweep_idle_timers(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Фоновая проверка простаивающих таймеров: напоминание, затем автозакрытие"""
+    now = utc_now()
+    for timer, stage in user_tasks.pop_idle(now.timestamp()):
+        user_id = timer.user_id
+        try:
+            if stage == IDLE_REMIND:
+                # Отметка в общем состоянии: о том же интервале не напомнят ни другая реплика, ни перезагрузка
+                timer.reminded = timer.intervals[-1]
+                try:
+                    await save_user_state(user_id)
+                except StaleStateError:
+                    await load_user_state(user_id)  # свежая версия заново поставит проверку таймера
+                    continue
+                await context.bot.send_message(
+                    chat_id=user_id,
+                    rate_limit_args=BULK,
+                    text=f"⏰ Задача #{timer.id} идет уже больше {TIMER_REMIND_HOURS:g} ч. Не забыли ее завершить?",
+                    reply_markup=InlineKeyboardMarkup([[
+                        InlineKeyboardButton("Завершить", callback_data=f'timer_end:{timer.id}'),
+                        InlineKeyboardButton("Пауза", callback_data=f'timer_pause:{timer.id}')
+                    ]])
+                )
+                user_tasks.schedule_idle(timer, IDLE_STALE)
+                continue
+            
+            timer = await claim_timer(user_id, timer.id)
+            if timer is None:
+                continue  # таймер уже закрыт здесь или в другой реплике
+            if not timer.description or user_id not in user_sheets:
+                await context.bot.send_message(
+                    chat_id=user_id,
+                    rate_limit_args=BULK,
+                    text=f"🗑 Задача #{timer.id} без ответа слишком долго и удалена без сохранения"
+                )
+                continue
+            
+            if not timer.paused:
+                # На напоминание не ответили — считаем, что работа закончилась к нему
+                timer.pause(datetime.fromtimestamp(timer.intervals[-1] + TIMER_REMIND_HOURS * 3600, pytz.utc))
+            rows = build_timer_rows(user_id, timer, now)
+            saved = await commit_rows(user_id, rows)
+            await context.bot.send_message(
+                chat_id=user_id,
+                rate_limit_args=BULK,
+                text=f"⏹ Задача #{timer.id} закрыта автоматически\n"
+                     + (format_saved_message(rows) if saved else format_deferred_message(rows)),
+                reply_markup=get_main_keyboard()
+            )
+        except Exception as e:
+            logger.error(f"Ошибка обработки простаивающего таймера #{timer.id}: {e}", exc_info=True)
+
+def filter_period(records, start_date, end_date):
+    """Разбирает записи и оставляет строки периода; возвращает (строки, число пропущенных)"""
+    rows, skipped = parse_records(records)
+    return [row for row in rows if start_date <= row.date <= end_date], skipped
+
+async def retry_journal(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Фоновый повтор записи задач из журнала с одним подтверждением пользователю"""
+    for entry in await in_journal(journal.due, time.time()):
+        try:
+            await save_rows(entry.user_id, entry.rows)
+        except Exception as e:
+            logger.warning(f"Повтор записи задачи {entry.id} (попытка {entry.attempts + 1}) не удался: {e}")
+            await in_journal(journal.mark_failed, entry, time.time())
+            continue
+        
+        await in_journal(journal.mark_done, entry)
+        try:
+            await context.bot.send_message(
+                chat_id=entry.user_id,
+                rate_limit_args=BULK,
+                text="☁️ Отложенная задача записана в таблицу\n" + format_saved_message(entry.rows)
+            )
+        except Exception as e:
+            logger.error(f"Не удалось отправить подтверждение {entry.user_id}: {e}")
+
+async def poll_sheet_changes(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Фоновая проверка ручных правок в подключенных таблицах"""
+    watched_ids = {sheet_info['id'] for sheet_info in user_sheets.values()}
+    if not watched_ids:
+        return
+    
+    try:
+        changed = await asyncio.to_thread(sheet_changes.poll, watched_ids)
+    except Exception as e:
+        logger.error(f"Ошибка проверки изменений таблиц: {e}", exc_info=True)
+        return
+    
+    for spreadsheet_id in changed:
+        logger.info(f"Таблица {spreadsheet_id} изменена, сбрасываем кэши")
+        invalidate_spreadsheet(spreadsheet_id)
+
+def format_report(user_id, rows, skipped, title):
+    """Текст отчета: итог, топ-5 тегов и задач по разобранным строкам периода"""
+    # Считаем общее время
+    total_hours = sum(row.hours for row in rows)
+    
+    # Собираем статистику по тегам (по id из словаря тегов пользователя)
+    tag_index = get_tag_index(user_id)
+    tags_summary = {}
+    for row in rows:
+        tag_ids = tag_index.ids_for(row.tags) or (None,)
+        for tag_id in tag_ids:
+            tags_summary[tag_id] = tags_summary.get(tag_id, 0) + row.hours
     
-    # Убираем кнопки из предыдущего сообщения
-    await query.edit_message_reply_markup(reply_markup=None)
+    # Собираем статистику по задачам
+    tasks_summary = {}
+    for row in rows:
+        task = row.task[:30] + '...' if len(row.task) > 30 else row.task
+        tasks_summary[task] = tasks_summary.get(task, 0) + row.hours
     
+    # Формируем отчет
+    report_lines = [
+        title,
+        f"⏱ Всего времени: {total_hours:.1f} ч",
+        "",
+        "🏷 По тегам:"
+    ]
+    
+    # Добавляем топ-5 тегов
+    for tag_id, hours in sorted(tags_summary.items(), key=lambda x: x[1], reverse=True)[:5]:
+        tag = 'без тега' if tag_id is None else tag_index.name(tag_id)
+        report_lines.append(f"• {tag}: {hours:.1f} ч")
+    
+    report_lines.extend(["", "📝 По задачам:"])
+    
+    # Добавляем топ-5 задач
+    for task, hours in sorted(tasks_summary.items(), key=lambda x: x[1], reverse=True)[:5]:
+        report_lines.append(f"• {task}: {hours:.1f} ч")
+    
+    if skipped:
+        report_lines.extend(["", f"⚠️ Пропущено строк с ошибками в дате или часах: {skipped}"])
+    
+    return "\n".join(report_lines)
+
+async def report_week(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Генерирует отчет за неделю"""
     user_id = update.effective_user.id
     if user_id not in user_sheets:
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id,
-            text="Сначала подключите Google таблицу через /start"
+        await respond(update, "Сначала подключите Google таблицу через /start")
+        return
+    
+    # Определяем период (последние 7 дней)
+    end_date = datetime.now(user_zone(user_id)).date()
+    start_date = end_date - timedelta(days=7)
+    
+    # Повторное нажатие до новой записи отдаем из кэша, не перечитывая таблицу
+    sheet_key = user_sheet_key(user_id)
+    period = ('week', end_date)
+    reply_markup = get_main_keyboard()
+    if CHARTS_AVAILABLE:
+        reply_markup = InlineKeyboardMarkup(
+            [[InlineKeyboardButton("📈 График", callback_data='report_chart')]]
+            + list(reply_markup.inline_keyboard)
         )
+    
+    cached_report = report_cache.get(sheet_key, user_id, period)
+    if cached_report:
+        await respond(update, cached_report, reply_markup)
         return
     
     try:
-        # Получаем данные из таблицы
-        spreadsheet_id = user_sheets[user_id]['id']
-        spreadsheet = client.open_by_key(spreadsheet_id)
-        worksheet = spreadsheet.sheet1
-        
-        # Получаем все записи (пропускаем заголовок)
-        records = worksheet.get_all_records()
+        # Получаем записи вкладки пользователя (и архивов, если период в них заходит)
+        records = await asyncio.to_thread(fetch_period_records, *sheet_key, start_date, end_date)
         
         if not records:
-            if hasattr(update, 'callback_query'):
-                await update.callback_query.answer("В таблице нет данных для отчета", show_alert=True)
-            else:
-                await update.message.reply_text("📊 В таблице нет данных для отчета")
+            await respond(update, alert="📊 В таблице нет данных для отчета")
             return
         
-        # Определяем период (последние 7 дней)
-        end_date = datetime.now().date()
-        start_date = end_date - timedelta(days=7)
-        
         # Фильтруем записи за период
-        filtered_data = []
-        for row in records:
-            try:
-                row_date = datetime.strptime(row['Дата'], '%Y-%m-%d').date()
-                if start_date <= row_date <= end_date:
-                    filtered_data.append(row)
-            except (ValueError, KeyError):
-                continue
+        filtered_data, skipped = filter_period(records, start_date, end_date)
         
         if not filtered_data:
-            if hasattr(update, 'callback_query'):
-                await update.callback_query.answer("Нет данных за последнюю неделю", show_alert=True)
-            else:
-                await update.message.reply_text("📊 Нет данных за последнюю неделю")
+            await respond(update, alert="📊 Нет данных за последнюю неделю")
             return
         
-        # Считаем общее время
-        total_hours = sum(float(row['Часы']) for row in filtered_data)
+        report_text = format_report(
+            user_id, filtered_data, skipped,
+            f"📊 Отчет за неделю ({start_date.strftime('%d.%m.%Y')} - {end_date.strftime('%d.%m.%Y')})"
+        )
         
-        # Собираем статистику по тегам
-        tags_summary = {}
-        for row in filtered_data:
-            tags = [t.strip() for t in row['Теги'].split(',')] if row.get('Теги') else ['без тега']
-            for tag in tags:
-                tags_summary[tag] = tags_summary.get(tag, 0) + float(row['Часы'])
+        report_cache.put(sheet_key, user_id, period, report_text)
         
-        # Собираем статистику по задачам
-        tasks_summary = {}
-        for row in filtered_data:
-            task = row['Задача'][:30] + '...' if len(row['Задача']) > 30 else row['Задача']
-            tasks_summary[task] = tasks_summary.get(task, 0) + float(row['Часы'])
+        # Отчет заменяет меню одной правкой, кнопки главного меню остаются под ним
+        await respond(update, report_text, reply_markup)
+            
+    except Exception as e:
+        logger.error(f"Ошибка формирования отчета: {e}", exc_info=True)
+        error_msg = f"❌ Ошибка при формировании отчета: {str(e)}"
+        await respond(update, error_msg, get_main_keyboard())
+           
+async def send_digest(context: ContextTypes.DEFAULT_TYPE, user_id, preference, local_today, semaphore):
+    """Собирает и отправляет дайджест одному пользователю"""
+    start_date, end_date = digests.digest_period(preference, local_today)
+    sheet_key = user_sheet_key(user_id)
+    period = ('week', end_date) if preference.period == digests.DIGEST_WEEKLY else ('day', end_date)
+    
+    report_text = report_cache.get(sheet_key, user_id, period)
+    if not report_text:
+        async with semaphore:
+            records = await asyncio.to_thread(fetch_period_records, *sheet_key, start_date, end_date)
+        rows, skipped = filter_period(records, start_date, end_date)
+        if not rows:
+            return  # пустой дайджест не отправляем
+        if preference.period == digests.DIGEST_WEEKLY:
+            title = f"📊 Отчет за неделю ({start_date.strftime('%d.%m.%Y')} - {end_date.strftime('%d.%m.%Y')})"
+        else:
+            title = f"📊 Отчет за {end_date.strftime('%d.%m.%Y')}"
+        report_text = format_report(user_id, rows, skipped, title)
+        report_cache.put(sheet_key, user_id, period, report_text)
+    
+    await context.bot.send_message(
+        chat_id=user_id,
+        text=f"📬 {report_text}",
+        reply_markup=get_main_keyboard(),
+        rate_limit_args=BULK
+    )
+
+async def send_digests(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Фоновая рассылка дайджестов, у каждого пользователя свой сдвиг в пределах DIGEST_WINDOW"""
+    now = utc_now()
+    due = []
+    for user_id, preference in list(user_digests.items()):
+        if user_id not in user_sheets:
+            continue
+        local_now = now.astimezone(user_zone(user_id))
+        if digests.is_due(preference, user_id, local_now, DIGEST_WINDOW):
+            # Отмечаем сразу: следующая проверка и другие реплики не возьмут пользователя повторно
+            preference.last_sent = local_now.date().isoformat()
+            try:
+                await save_user_state(user_id)
+            except StaleStateError:
+                await load_user_state(user_id)
+                continue
+            due.append((user_id, preference, local_now.date()))
+    if not due:
+        return
+    
+    semaphore = asyncio.Semaphore(DIGEST_CONCURRENCY)
+    results = await asyncio.gather(
+        *(send_digest(context, user_id, preference, local_today, semaphore) for user_id, preference, local_today in due),
+        return_exceptions=True
+    )
+    for (user_id, _, _), result in zip(due, results):
+        if isinstance(result, Exception):
+            logger.warning(f"Дайджест для {user_id} не отправлен: {result}")
+
+async def archive_old_rows(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Фоновый перенос старых строк всех подключенных вкладок в годовые архивы"""
+    cutoff = archive_cutoff()
+    for sheet_key in {user_sheet_key(user_id) for user_id in list(user_sheets)}:
+        try:
+            async with shared_sheet_lock(sheet_key, ARCHIVE_LOCK_TTL):
+                moved = await asyncio.to_thread(archive_sheet, sheet_key, cutoff)
+        except Exception as e:
+            logger.error(f"Ошибка архивации вкладки {sheet_key}: {e}", exc_info=True)
+            continue
+        if moved:
+            logger.info(f"🗄 Вкладка {sheet_key}: в архив перенесено строк {moved}")
+
+async def team_report(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Сводный отчет команды за неделю по всем подключенным вкладкам"""
+    if update.effective_user.id not in TEAM_REPORT_ADMINS:
+        await update.message.reply_text("🔒 Командный отчет доступен только руководителям")
+        return
+    
+    # Несколько пользователей могут писать в одну вкладку проекта — читаем ее один раз
+    sheets = {}
+    for sheet_info in user_sheets.values():
+        sheet_key = (sheet_info['id'], sheet_info.get('worksheet_id'))
+        sheets.setdefault(sheet_key, sheet_info.get('worksheet_title') or sheet_info['id'])
+    
+    if not sheets:
+        await update.message.reply_text("📊 Нет подключенных таблиц")
+        return
+    
+    status_message = await update.message.reply_text(f"🔄 Собираю данные из {len(sheets)} таблиц...")
+    semaphore = asyncio.Semaphore(TEAM_REPORT_CONCURRENCY)
+    
+    end_date = datetime.now(get_zone(DEFAULT_TIMEZONE)).date()
+    start_date = end_date - timedelta(days=7)
+    cutoff = archive_cutoff()
+    
+    async def load_rollup(sheet_key):
+        rollup = rollup_cache.get(sheet_key)
+        if rollup is None:
+            async with semaphore:
+                records = await asyncio.to_thread(fetch_sheet_records, *sheet_key)
+            rollup = build_daily_rollup(records)
+            rollup_cache.put(sheet_key, rollup)
+        if start_date < cutoff:
+            # Период заходит в архив: добавляем сохраненные итоги архивных лет
+            async with semaphore:
+                archived = [
+                    await asyncio.to_thread(load_archive_rollup, sheet_key, year)
+                    for year in range(start_date.year, min(end_date, cutoff).year + 1)
+                ]
+            rollup = merge_rollups(rollup, *archived)
+        return rollup
+    
+    results = await asyncio.gather(*(load_rollup(key) for key in sheets), return_exceptions=True)
+    
+    total_hours = 0.0
+    people_summary = {}
+    tag_index = TagIndex()  # общий словарь, чтобы теги разных людей сливались
+    tags_summary = {}
+    tasks_summary = {}
+    failed = []
+    for (sheet_key, person), result in zip(sheets.items(), results):
+        if isinstance(result, Exception):
+            logger.error(f"Ошибка чтения таблицы {sheet_key}: {result}")
+            failed.append(person)
+            continue
         
-        # Формируем отчет
-        report_lines = [
-            f"📊 Отчет за неделю ({start_date.strftime('%d.%m.%Y')} - {end_date.strftime('%d.%m.%Y')})",
-            f"⏱ Всего времени: {total_hours:.1f} ч",
-            "",
-            "🏷 По тегам:"
-        ]
+        hours, tags, tasks = sum_period(result, start_date, end_date)
+        total_hours += hours
+        people_summary[person] = hours
+        for tag, tag_hours in tags.items():
+            tag_id = tag_index.intern(tag)
+            tags_summary[tag_id] = tags_summary.get(tag_id, 0) + tag_hours
+        for task, task_hours in tasks.items():
+            task = task[:30] + '...' if len(task) > 30 else task
+            tasks_summary[task] = tasks_summary.get(task, 0) + task_hours
+    
+    report_lines = [
+        f"👥 Командный отчет ({start_date.strftime('%d.%m.%Y')} - {end_date.strftime('%d.%m.%Y')})",
+        f"⏱ Всего времени: {total_hours:.1f} ч",
+        "",
+        "🙋 По людям:"
+    ]
+    for person, hours in sorted(people_summary.items(), key=lambda x: x[1], reverse=True):
+        report_lines.append(f"• {person}: {hours:.1f} ч")
+    
+    report_lines.extend(["", "🏷 По тегам:"])
+    for tag_id, hours in sorted(tags_summary.items(), key=lambda x: x[1], reverse=True)[:5]:
+        report_lines.append(f"• {tag_index.name(tag_id)}: {hours:.1f} ч")
+    
+    report_lines.extend(["", "📝 По задачам:"])
+    for task, hours in sorted(tasks_summary.items(), key=lambda x: x[1], reverse=True)[:5]:
+        report_lines.append(f"• {task}: {hours:.1f} ч")
+    
+    if failed:
+        report_lines.extend(["", f"⚠️ Не удалось прочитать: {', '.join(failed)}"])
+    
+    await status_message.edit_text("\n".join(report_lines))
+
+async def report_chart(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Отправляет график часов за неделю по дням с разбивкой по тегам"""
+    global chart_executor
+    query = update.callback_query
+    
+    user_id = update.effective_user.id
+    if user_id not in user_sheets:
+        await query.answer("Сначала подключите Google таблицу через /start", show_alert=True)
+        return
+    await query.answer()
+    
+    try:
+        end_date = datetime.now(user_zone(user_id)).date()
+        start_date = end_date - timedelta(days=7)
+        sheet_key = user_sheet_key(user_id)
+        
+        # Версия данных вкладки меняется при каждой записи и ручной правке: та же версия — та же картинка
+        cache_key = (user_id, start_date, end_date, sheet_versions.get(sheet_key, 0))
+        file_id = chart_cache.get(cache_key)
+        if file_id:
+            await context.bot.send_photo(chat_id=update.effective_chat.id, photo=file_id)
+            return
         
-        # Добавляем топ-5 тегов
-        for tag, hours in sorted(tags_summary.items(), key=lambda x: x[1], reverse=True)[:5]:
-            report_lines.append(f"• {tag}: {hours:.1f} ч")
+        records = await asyncio.to_thread(fetch_period_records, *sheet_key, start_date, end_date)
         
-        report_lines.extend(["", "📝 По задачам:"])
+        tag_index = get_tag_index(user_id)
+        rows = []
+        for row in filter_period(records, start_date, end_date)[0]:
+            tag_ids = tag_index.ids_for(row.tags) or (None,)
+            rows.append((row.date, {tag_id: row.hours for tag_id in tag_ids}))
         
-        # Добавляем топ-5 задач
-        for task, hours in sorted(tasks_summary.items(), key=lambda x: x[1], reverse=True)[:5]:
-            report_lines.append(f"• {task}: {hours:.1f} ч")
+        days = [start_date + timedelta(days=i) for i in range((end_date - start_date).days + 1)]
+        tag_labels, matrix = hours_by_day_and_tag(
+            rows, days, lambda tag_id: 'без тега' if tag_id is None else tag_index.name(tag_id)
+        )
         
-        # Формируем итоговый текст отчета
-        report_text = "\n".join(report_lines)
+        if chart_executor is None:
+            # Не fork: в процессе уже работают потоки to_thread и HTTP-сессии, их блокировки копировать нельзя
+            chart_executor = ProcessPoolExecutor(
+                max_workers=CHART_WORKERS, mp_context=multiprocessing.get_context('forkserver')
+            )
+        png = await asyncio.get_running_loop().run_in_executor(
+            chart_executor,
+            render_hours_chart,
+            [day.strftime('%d.%m') for day in days],
+            tag_labels,
+            matrix,
+            f"Часы за {start_date.strftime('%d.%m')} - {end_date.strftime('%d.%m')}"
+        )
         
-        # Отправляем отчет как новое сообщение с кнопками главного меню
+        message = await context.bot.send_photo(chat_id=update.effective_chat.id, photo=png)
+        if len(chart_cache) >= CHART_CACHE_SIZE:
+            del chart_cache[next(iter(chart_cache))]
+        chart_cache[cache_key] = message.photo[-1].file_id
+        
+    except Exception as e:
+        logger.error(f"Ошибка построения графика: {e}", exc_info=True)
         await context.bot.send_message(
             chat_id=update.effective_chat.id,
-            text=report_text,
-            reply_markup=get_main_keyboard()
+            text=f"❌ Ошибка при построении графика: {str(e)}"
         )
+
+IMPORT_MAX_FILE_SIZE = 20 * 1024 * 1024  # больше бот скачать не может
+IMPORT_PROGRESS_INTERVAL = 3  # секунд между обновлениями сообщения о прогрессе
+IMPORT_ERRORS_SHOWN = 5
+
+async def import_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Обработчик команды /import"""
+    if update.effective_user.id not in user_sheets:
+        await update.message.reply_text("Сначала подключите Google таблицу через /start")
+        return ConversationHandler.END
+    
+    await update.message.reply_text(
+        "📥 Пришлите CSV-файл с историей.\n"
+        "Обязательные колонки: Дата, Часы, Задача; необязательные: Начало, Конец, Теги.\n"
+        "Отмена: /cancel"
+    )
+    return IMPORT_FILE
+
+async def handle_import_file(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Построчно импортирует CSV во вкладку пользователя пакетами"""
+    user_id = update.effective_user.id
+    document = update.message.document
+    if document.file_size and document.file_size > IMPORT_MAX_FILE_SIZE:
+        await update.message.reply_text("❌ Файл больше 20 МБ, разбейте его на части")
+        return IMPORT_FILE
+    
+    # Весь прогресс — правками одного сообщения
+    status_message = await update.message.reply_text("🔄 Загружаю файл...")
+    imported = 0
+    skipped = 0
+    errors = []
+    
+    try:
+        with NamedTemporaryFile(suffix='.csv') as tmp:
+            telegram_file = await document.get_file()
+            await telegram_file.download_to_drive(tmp.name)
+            
+            worksheet = await asyncio.to_thread(open_user_worksheet, user_id)
+            headers = await asyncio.to_thread(get_sheet_headers, user_id, worksheet)
+            tag_index = get_tag_index(user_id)
             
+            handle, reader = importer.open_csv(tmp.name)
+            with handle:
+                chunk = []
+                last_write = 0.0
+                last_progress = time.monotonic()
+                for result in importer.read_import_rows(reader, tag_index.canonical):
+                    if result[0] == 'error':
+                        skipped += 1
+                        if len(errors) < IMPORT_ERRORS_SHOWN:
+                            errors.append(result[1:])
+                        continue
+                    
+                    chunk.append(sheet_row(headers, result[1]))
+                    if len(chunk) < importer.CHUNK_ROWS:
+                        continue
+                    
+                    last_write = await asyncio.to_thread(importer.write_chunk, worksheet, chunk, last_write)
+                    imported += len(chunk)
+                    chunk = []
+                    if time.monotonic() - last_progress >= IMPORT_PROGRESS_INTERVAL:
+                        last_progress = time.monotonic()
+                        await status_message.edit_text(
+                            f"🔄 Импортировано строк: {imported}, пропущено: {skipped}..."
+                        )
+                
+                if chunk:
+                    await asyncio.to_thread(importer.write_chunk, worksheet, chunk, last_write)
+                    imported += len(chunk)
+        
+        text = f"✅ Импорт завершен: добавлено строк {imported}, пропущено {skipped}"
+        if errors:
+            text += "\n\nПервые ошибки:\n" + importer.format_errors(errors)
+    
+    except importer.CsvImportError as e:
+        text = f"❌ Не удалось импортировать файл: {e}"
     except Exception as e:
-        logger.error(f"Ошибка формирования отчета: {e}", exc_info=True)
-        error_msg = f"❌ Ошибка при формировании отчета: {str(e)}"
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id,
-            text=error_msg,
-            reply_markup=get_main_keyboard()
+        logger.error(f"Ошибка импорта: {e}", exc_info=True)
+        text = (
+            f"❌ Импорт прерван: {str(e)}\n"
+            f"Успели добавить строк: {imported}"
         )
-           
+    finally:
+        if imported:
+            invalidate_sheet(user_sheet_key(user_id))
+    
+    await status_message.edit_text(text, reply_markup=get_main_keyboard())
+    return ConversationHandler.END
+
+async def cancel_import(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Отмена импорта"""
+    await update.message.reply_text("Импорт отменен.", reply_markup=get_main_keyboard())
+    return ConversationHandler.END
+
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Обработчик нажатий на кнопки"""
+    """Остальные нажатия: отчеты и кнопки, которых уже нет в диалоге (на callback отвечает вызываемый обработчик)
+
+    Кнопки задач разбирает task_conv_handler; он зарегистрирован раньше.
+    """
     query = update.callback_query
-    await query.answer()
     
-    if query.data == 'task_start':
-        await task_start(update, context)
-    elif query.data == 'task_end':
-        await query.edit_message_reply_markup(reply_markup=None)
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id,
-            text="Обрабатываю завершение задачи..."
-        )
-        await task_end(update, context)
-    elif query.data == 'report_week':
-        await report_week(update, context)
-    elif query.data == 'report_month':
-        await query.edit_message_reply_markup(reply_markup=None)
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id,
-            text="Формирую отчет за месяц..."
-        )
+    if query.data in ('report_week', 'report_month'):
         await report_week(update, context)
+    else:
+        await query.answer()
 
 
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -563,72 +1637,273 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
                 "⚠️ Произошла ошибка. Напиши Насте."
             )
 
+def current_state():
+    """Состояние процесса для STATE_FILE"""
+    return {
+        'user_sheets': user_sheets,
+        'user_timezones': user_timezones,
+        'user_digests': {user_id: preference.to_dict() for user_id, preference in user_digests.items()},
+        'timers': user_tasks.snapshot(),
+        # Счетчик, а не только таймеры: без запущенных таймеров id начались бы снова с 1
+        'next_timer_id': user_tasks.next_id,
+        'tag_indexes': {user_id: tag_index.to_dict() for user_id, tag_index in tag_indexes.items()}
+    }
+
+def write_state_file(text, version):
+    """Атомарно записывает снимок на диск (блокирующий вызов); более старый снимок новый не затирает"""
+    with state_file_lock:
+        if version <= written_state['version'] or text == written_state['text']:
+            return
+        tmp_path = f"{STATE_FILE}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(tmp_path, STATE_FILE)
+        written_state.update(version=version, text=text)
+
+async def save_state_file():
+    """Обновляет STATE_FILE, если состояние изменилось
+
+    Вызывается после каждого обновления и по таймеру: после падения процесса
+    (OOM, SIGKILL) при запуске восстановится свежее состояние, а не снимок прошлой остановки.
+    """
+    text = json.dumps(current_state(), ensure_ascii=False)
+    await asyncio.to_thread(write_state_file, text, next(state_file_versions))
+
+async def save_state_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Фоновая запись состояния: изменения из фоновых задач (автозакрытие таймеров и т.п.)"""
+    await save_state_file()
+
+async def restore_state():
+    """Восстанавливает состояние прошлого запуска и дописывает незаписанные задачи"""
+    if not os.path.exists(STATE_FILE):
+        return
+    try:
+        with open(STATE_FILE, encoding='utf-8') as f:
+            state = json.load(f)
+    except (OSError, ValueError) as e:
+        logger.error(f"Не удалось прочитать {STATE_FILE}: {e}")
+        return
+    # Файл не удаляем: он переписывается при каждом изменении (save_state_file) и нужен после падения
+    
+    # Ключи JSON — строки, возвращаем числовые user_id
+    user_sheets.update({int(user_id): info for user_id, info in state.get('user_sheets', {}).items()})
+    user_timezones.update({int(user_id): zone for user_id, zone in state.get('user_timezones', {}).items()})
+    user_digests.update({
+        int(user_id): digests.DigestPreference.from_dict(data)
+        for user_id, data in state.get('user_digests', {}).items()
+    })
+    user_tasks.restore(state.get('timers', []))
+    user_tasks.skip_ids(state.get('next_timer_id', 1))
+    tag_indexes.update({
+        int(user_id): TagIndex.from_dict(data) for user_id, data in state.get('tag_indexes', {}).items()
+    })
+    logger.info(f"♻️ Восстановлено таймеров: {len(user_tasks)}")
+
 async def post_init(application: Application):
-    webhook_url = f"https://kplusbot-timetrack.onrender.com/{TOKEN}"
-    await application.bot.set_webhook(webhook_url)
+    await restore_state()
+    # Незаписанные задачи прошлого запуска подхватит retry_journal
+    await in_journal(journal.load)
+    logger.info(f"♻️ В журнале ожидают записи задач: {len(journal)}")
+    if state_store.shared:
+        for user_id in await state_store.user_ids():
+            await load_user_state(user_id)
+        logger.info(f"♻️ Из общего хранилища загружено пользователей: {len(user_versions)}")
+    
+    health_probes.register('telegram', application.bot.get_me)
+    health_probes.register('sheets', lambda: asyncio.to_thread(
+        client.request, 'get', DRIVE_ABOUT_URL, params={'fields': 'user(emailAddress)'}
+    ))
+    
+    webhook_url = f"{WEBHOOK_BASE_URL}{WEBHOOK_PATH}"
+    # Обновления, накопившиеся за время выкладки, не выбрасываем: повторные доставки отсеет update_dedupe
+    await application.bot.set_webhook(webhook_url, secret_token=WEBHOOK_SECRET, drop_pending_updates=False)
     logger.info(f"✅ Webhook установлен на {webhook_url}")
 
-def main() -> None:
-    TOKEN = os.getenv('TELEGRAM_TOKEN')
-    if not TOKEN:
-        raise ValueError("Токен не найден!") 
+async def post_shutdown(application: Application, timeout=SHUTDOWN_DRAIN_SECONDS):
+    """Остановка: прием обновлений уже прекращен, дожидаемся записей (не дольше timeout) и сохраняем остальное"""
+    if pending_saves and timeout > 0:
+        logger.info(f"⏳ Ждем незавершенные записи: {len(pending_saves)}")
+        await asyncio.wait(list(pending_saves), timeout=timeout)
+    
+    # Что не успело записаться за отведенное время, осталось в журнале и будет повторено при запуске
+    await save_state_file()
+    logger.info(f"💾 Сохранено таймеров: {len(user_tasks)}, в журнале задач: {len(journal)}")
+    
+    if chart_executor is not None:
+        chart_executor.shutdown(wait=False, cancel_futures=True)
+    await state_store.close()
+
+async def refresh_health(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Фоновое обновление проверок для /ready"""
+    await health_probes.refresh()
+
+def queue_depth(application):
+    """Длины очередей для /ready"""
+    return {
+        'updates': application.update_queue.qsize(),
+        'outgoing': len(rate_limiter),
+        'pending_saves': len(pending_saves),
+        'journal': len(journal),
+    }
+
+async def run_webhook_server(application: Application):
+    """Запускает бота за собственным aiohttp-сервером до SIGTERM/SIGINT"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
     
+    web_app = create_web_app(
+        application, WEBHOOK_PATH, WEBHOOK_SECRET, health_probes, lambda: queue_depth(application),
+        update_dedupe, trust_proxy=WEBHOOK_TRUST_PROXY
+    )
+    runner = web.AppRunner(web_app)
+    async with application:
+        await post_init(application)
+        await application.start()
+        await runner.setup()
+        await web.TCPSite(runner, WEBHOOK_LISTEN, WEBHOOK_PORT).start()
+        logger.info(f"🌐 Сервер слушает {WEBHOOK_LISTEN}:{WEBHOOK_PORT}")
+        try:
+            await stop.wait()
+        finally:
+            # Сначала перестаем принимать обновления, потом дорабатываем принятые.
+            # stop() ждет обработчики и фоновые задачи без ограничения (долгий /import, архивация),
+            # поэтому состояние пишется заранее, а на доработку есть SHUTDOWN_DRAIN_SECONDS до SIGKILL
+            deadline = loop.time() + SHUTDOWN_DRAIN_SECONDS
+            await runner.cleanup()
+            await save_state_file()
+            try:
+                await asyncio.wait_for(application.stop(), SHUTDOWN_DRAIN_SECONDS)
+            except asyncio.TimeoutError:
+                logger.warning(f"⌛ Обработчики не завершились за {SHUTDOWN_DRAIN_SECONDS:g} с, останавливаемся")
+            await post_shutdown(application, deadline - loop.time())
+
+def build_application(builder):
+    """Собирает приложение: обработчики, хранилище разговоров и фоновые задачи
+
+    builder — ApplicationBuilder с токеном и сетевыми настройками.
+    """
     # Обработчик старта и подключения таблицы
     start_conv_handler = ConversationHandler(
+        name='start',
+        persistent=True,
         entry_points=[CommandHandler('start', start)],
         states={
             START: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_spreadsheet_url)],
         },
-        fallbacks=[CommandHandler('cancel', cancel)],
+        fallbacks=[CommandHandler('cancel', cancel_start)],
     )
     
-    # Обработчик задач
+    # Обработчик задач; кнопки задач (и «Завершить» из напоминания) заново входят в диалог из любого состояния
     task_conv_handler = ConversationHandler(
+    name='task',
+    persistent=True,
+    allow_reentry=True,
     entry_points=[
         CallbackQueryHandler(task_start, pattern='^task_start$'),
-        CallbackQueryHandler(task_end, pattern='^task_end$')
+        CallbackQueryHandler(task_end, pattern='^task_end$'),
+        CallbackQueryHandler(timer_selected, pattern=r'^timer_end:\d+$')
     ],
     states={
         TASK_DESCRIPTION: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_task_description)],
         TASK_TAGS: [
             MessageHandler(filters.TEXT & ~filters.COMMAND, handle_task_tags),
             CallbackQueryHandler(confirm_end_task, pattern='^(confirm_end|cancel_end)$'),
-            CallbackQueryHandler(skip_tags, pattern='^skip_tags$')
+            CallbackQueryHandler(skip_tags, pattern='^skip_tags$'),
+            CallbackQueryHandler(toggle_tag, pattern=r'^tag:\d+$'),
+            CallbackQueryHandler(tags_done, pattern='^tags_done$')
         ]
     },
     fallbacks=[CommandHandler('cancel', cancel)]
     )
+    # Импорт истории из CSV
+    import_conv_handler = ConversationHandler(
+        name='import',
+        entry_points=[CommandHandler('import', import_start)],
+        states={
+            IMPORT_FILE: [MessageHandler(filters.Document.ALL, handle_import_file)],
+        },
+        fallbacks=[CommandHandler('cancel', cancel_import)],
+    )
     application = (
-    ApplicationBuilder()
-    .token(TOKEN)
-    .post_init(post_init)
+    builder
+    .rate_limiter(rate_limiter)
+    .persistence(SQLitePersistence(PERSISTENCE_FILE))
     .concurrent_updates(True)
-    .http_version("1.1")
     .build()
 )
 
 # Регистрируем обработчики
-    application.add_handler(TypeHandler(Update, handle_webhook_update))
+    # Синхронизация состояния с другими репликами: до всех обработчиков и после них
+    application.add_handler(TypeHandler(Update, sync_user_state_in), group=-1)
+    application.add_handler(TypeHandler(Update, sync_user_state_out), group=1)
     application.add_handler(CallbackQueryHandler(start_button, pattern='^start$'))
+    application.add_handler(CallbackQueryHandler(show_timers, pattern='^timers$'))
+    application.add_handler(CallbackQueryHandler(report_chart, pattern='^report_chart$'))
+    application.add_handler(CallbackQueryHandler(toggle_timer_pause, pattern=r'^timer_(pause|resume):\d+$'))
 
     application.add_handler(CommandHandler('taskend', end_task))
     application.add_handler(CommandHandler('reportweek', report_week))
     application.add_handler(CommandHandler('reportmonth', report_week))  # Временная заглушка
+    application.add_handler(CommandHandler('teamreport', team_report))
+    application.add_handler(CommandHandler('timezone', set_timezone))
+    application.add_handler(CommandHandler('digest', set_digest))
+    # В группе срабатывает только первый подходящий обработчик: диалоги раньше кнопки без шаблона.
+    # Диалог задач раньше диалога подключения: текст, пока ждем описание задачи, — описание, а не ссылка
+    application.add_handler(task_conv_handler)
+    application.add_handler(import_conv_handler)
+    application.add_handler(start_conv_handler)
+    conversation_handlers[:] = [task_conv_handler, import_conv_handler, start_conv_handler]
     application.add_handler(CallbackQueryHandler(button_handler))
     application.add_error_handler(error_handler)
-    application.add_handler(start_conv_handler)
-    application.add_handler(task_conv_handler)
+    application.job_queue.run_repeating(
+        sweep_idle_timers,
+        interval=IDLE_SWEEP_INTERVAL,
+        first=IDLE_SWEEP_INTERVAL
+    )
+    application.job_queue.run_repeating(
+        retry_journal,
+        interval=JOURNAL_RETRY_INTERVAL,
+        first=JOURNAL_RETRY_INTERVAL
+    )
+    application.job_queue.run_repeating(
+        send_digests,
+        interval=DIGEST_CHECK_INTERVAL,
+        first=DIGEST_CHECK_INTERVAL
+    )
+    if ARCHIVE_ENABLED:
+        application.job_queue.run_repeating(
+            archive_old_rows,
+            interval=ARCHIVE_INTERVAL,
+            first=ARCHIVE_INTERVAL
+        )
+    application.job_queue.run_repeating(
+        save_state_job,
+        interval=STATE_FILE_INTERVAL,
+        first=STATE_FILE_INTERVAL
+    )
+    application.job_queue.run_repeating(
+        refresh_health,
+        interval=READY_PROBE_INTERVAL,
+        first=0
+    )
+    application.job_queue.run_repeating(
+        poll_sheet_changes,
+        interval=SHEET_POLL_INTERVAL,
+        first=0
+    )
 
     logger.info(f"🛠 Всего обработчиков: {len(application.handlers[0])}")
+    return application
 
+def main() -> None:
+    TOKEN = os.getenv('TELEGRAM_TOKEN')
+    if not TOKEN:
+        raise ValueError("Токен не найден!") 
     
-    application.run_webhook(
-        listen="0.0.0.0",
-        port=10000,
-        webhook_url=f"https://kplusbot-timetrack.onrender.com/{TOKEN}",
-        secret_token="YOUR_SECRET",
-        drop_pending_updates=True
-    )
+    application = build_application(ApplicationBuilder().token(TOKEN).http_version("1.1"))
+    asyncio.run(run_webhook_server(application))
 '''
 def main():
     application = ApplicationBuilder().token(TOKEN).post_init(post_init).build()
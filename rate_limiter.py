@@ -0,0 +1,184 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты запросов: меньше — раньше
+PRIORITY_INTERACTIVE = 0  # ответы на действия пользователя (по умолчанию)
+PRIORITY_BULK = 10        # рассылки: напоминания, дайджесты, фоновые подтверждения
+
+GLOBAL_RATE = 30              # запросов в секунду на бота
+PRIVATE_RATE = 1              # сообщений в секунду в личный чат
+PRIVATE_BURST = 3
+GROUP_RATE = 20 / 60          # сообщений в секунду в группу
+GROUP_BURST = 3
+MAX_RETRIES = 3               # повторов после 429
+MAX_CHAT_BUCKETS = 10000      # сверх этого забываем чаты с полным запасом
+
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity про запас"""
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated', 'blocked_until')
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+        self.blocked_until = 0.0  # до этого времени Telegram просил не отправлять (retry_after)
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        """Через сколько секунд будет доступен токен (0 — уже есть)"""
+        self._refill(now)
+        wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(wait, self.blocked_until - now)
+
+    def full(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity and self.blocked_until <= now
+
+    def take(self):
+        self.tokens -= 1
+
+    def block(self, until):
+        self.blocked_until = max(self.blocked_until, until)
+
+
+def is_group_chat(chat_id):
+    return str(chat_id).startswith(('-', '@'))
+
+
+class PriorityRateLimiter(BaseRateLimiter):
+    """Очередь исходящих запросов к Telegram с общим и початовыми лимитами
+
+    Каждый запрос бота ждет разрешения диспетчера: сначала обслуживаются
+    запросы с меньшим приоритетом, а запрос в чат без свободного токена
+    откладывается и не задерживает остальные чаты. При 429 чат (или весь бот,
+    если чата нет) замирает на retry_after, и запрос повторяется.
+
+    Приоритет задается при вызове: rate_limit_args={'priority': PRIORITY_BULK}.
+    """
+
+    def __init__(self, global_rate=GLOBAL_RATE, max_retries=MAX_RETRIES):
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, global_rate, time.monotonic())
+        self._chats = {}     # {chat_id: TokenBucket}
+        self._ready = []     # куча (приоритет, номер, chat_id, future)
+        self._delayed = []   # куча (время готовности, приоритет, номер, chat_id, future)
+        self._seq = itertools.count()
+        self._wakeup = None
+        self._dispatcher = None
+        self.retried = 0     # запросов, повторенных после 429
+
+    async def initialize(self):
+        self._wakeup = asyncio.Event()
+        self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def shutdown(self):
+        if self._dispatcher:
+            self._dispatcher.cancel()
+            self._dispatcher = None
+        # Ждущие запросы отпускаем без очереди: бот останавливается
+        for item in self._ready + self._delayed:
+            if not item[-1].done():
+                item[-1].set_result(None)
+        self._ready.clear()
+        self._delayed.clear()
+
+    def __len__(self):
+        """Сколько запросов ждут отправки"""
+        return len(self._ready) + len(self._delayed)
+
+    def _chat_bucket(self, chat_id, now):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= MAX_CHAT_BUCKETS:
+                self._chats = {key: value for key, value in self._chats.items() if not value.full(now)}
+            if is_group_chat(chat_id):
+                bucket = TokenBucket(GROUP_RATE, GROUP_BURST, now)
+            else:
+                bucket = TokenBucket(PRIVATE_RATE, PRIVATE_BURST, now)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    async def _acquire(self, chat_id, priority):
+        if self._dispatcher is None or self._dispatcher.done():
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._ready, (priority, next(self._seq), chat_id, future))
+        self._wakeup.set()
+        await future
+
+    async def _sleep(self, timeout):
+        """Ждет новый запрос или timeout секунд"""
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _dispatch(self):
+        while True:
+            now = time.monotonic()
+            while self._delayed and self._delayed[0][0] <= now:
+                heapq.heappush(self._ready, heapq.heappop(self._delayed)[1:])
+
+            if not self._ready:
+                await self._sleep(self._delayed[0][0] - now if self._delayed else None)
+                continue
+
+            priority, seq, chat_id, future = self._ready[0]
+            if future.done():
+                # Запрос отменили, пока он ждал
+                heapq.heappop(self._ready)
+                continue
+
+            if chat_id is not None:
+                chat_wait = self._chat_bucket(chat_id, now).wait_time(now)
+                if chat_wait > 0:
+                    heapq.heappop(self._ready)
+                    heapq.heappush(self._delayed, (now + chat_wait, priority, seq, chat_id, future))
+                    continue
+
+            global_wait = self._global.wait_time(now)
+            if global_wait > 0:
+                # Пока ждем, может прийти запрос важнее — он и получит токен
+                await self._sleep(global_wait)
+                continue
+
+            heapq.heappop(self._ready)
+            self._global.take()
+            if chat_id is not None:
+                self._chats[chat_id].take()
+            future.set_result(None)
+
+    def _block(self, chat_id, retry_after):
+        until = time.monotonic() + retry_after
+        if chat_id is None:
+            self._global.block(until)
+        else:
+            self._chat_bucket(chat_id, time.monotonic()).block(until)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        priority = (rate_limit_args or {}).get('priority', PRIORITY_INTERACTIVE)
+        chat_id = data.get('chat_id')
+        for attempt in range(self.max_retries + 1):
+            await self._acquire(chat_id, priority)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                logger.warning(f"429 на {endpoint} для чата {chat_id}: пауза {e.retry_after} с")
+                self.retried += 1
+                self._block(chat_id, e.retry_after)
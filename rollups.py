@@ -0,0 +1,97 @@
+import time
+
+from row_parser import parse_records
+from tags import split_tags
+
+
+def build_daily_rollup(records):
+    """Сворачивает строки вкладки в итоги по дням: {date: {'hours', 'tags', 'tasks'}}"""
+    rollup = {}
+    for row in parse_records(records)[0]:
+        day = rollup.get(row.date)
+        if day is None:
+            day = rollup[row.date] = {'hours': 0.0, 'tags': {}, 'tasks': {}}
+        day['hours'] += row.hours
+        for tag in split_tags(row.tags) or ['без тега']:
+            day['tags'][tag] = day['tags'].get(tag, 0) + row.hours
+        day['tasks'][row.task] = day['tasks'].get(row.task, 0) + row.hours
+    return rollup
+
+
+def merge_rollups(*rollups):
+    """Складывает дневные свертки (например, рабочей вкладки и ее архивов)"""
+    merged = {}
+    for rollup in rollups:
+        for row_date, day in rollup.items():
+            target = merged.get(row_date)
+            if target is None:
+                merged[row_date] = {'hours': day['hours'], 'tags': dict(day['tags']), 'tasks': dict(day['tasks'])}
+                continue
+            target['hours'] += day['hours']
+            for tag, hours in day['tags'].items():
+                target['tags'][tag] = target['tags'].get(tag, 0) + hours
+            for task, hours in day['tasks'].items():
+                target['tasks'][task] = target['tasks'].get(task, 0) + hours
+    return merged
+
+
+def sum_period(rollup, start_date, end_date):
+    """Итоги за период из дневной свертки: (часы, {тег: часы}, {задача: часы})"""
+    total = 0.0
+    tags = {}
+    tasks = {}
+    for row_date, day in rollup.items():
+        if not start_date <= row_date <= end_date:
+            continue
+        total += day['hours']
+        for tag, hours in day['tags'].items():
+            tags[tag] = tags.get(tag, 0) + hours
+        for task, hours in day['tasks'].items():
+            tasks[task] = tasks.get(task, 0) + hours
+    return total, tags, tasks
+
+
+class RollupCache:
+    """Кэш дневных сверток по вкладкам; сбрасывается при записи или по истечении ttl"""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._entries = {}  # {(spreadsheet_id, worksheet_id): (время построения, свертка)}
+
+    def get(self, sheet_key):
+        entry = self._entries.get(sheet_key)
+        if entry is None or time.monotonic() - entry[0] > self.ttl:
+            return None
+        return entry[1]
+
+    def put(self, sheet_key, rollup):
+        self._entries[sheet_key] = (time.monotonic(), rollup)
+
+    def invalidate(self, sheet_key):
+        self._entries.pop(sheet_key, None)
+
+
+class ReportCache:
+    """Готовые тексты отчетов пользователей, сгруппированные по вкладкам
+
+    Группировка по вкладке позволяет при записи в нее сбросить отчеты всех,
+    кто в нее пишет, одной операцией. Для каждого вида отчета пользователя
+    хранится только последний период: вчерашние отчеты вытесняются сегодняшними,
+    и у вкладок без записей кэш не растет.
+    """
+
+    def __init__(self):
+        self._by_sheet = {}  # {(spreadsheet_id, worksheet_id): {(user_id, вид): (период, текст)}}
+
+    def get(self, sheet_key, user_id, period):
+        entry = self._by_sheet.get(sheet_key, {}).get((user_id, period[0]))
+        if entry is None or entry[0] != period:
+            return None
+        return entry[1]
+
+    def put(self, sheet_key, user_id, period, text):
+        """period — (вид, конец периода), например ('week', date)"""
+        self._by_sheet.setdefault(sheet_key, {})[(user_id, period[0])] = (period, text)
+
+    def invalidate(self, sheet_key):
+        self._by_sheet.pop(sheet_key, None)
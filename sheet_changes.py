@@ -0,0 +1,56 @@
+DRIVE_FILES_URL = 'https://www.googleapis.com/drive/v3/files'
+SPREADSHEET_MIME_TYPE = 'application/vnd.google-apps.spreadsheet'
+
+
+class SheetChangeDetector:
+    """Находит изменившиеся таблицы одним запросом files.list к Drive
+
+    Вместо запроса метаданных по каждой таблице спрашиваем у Drive все таблицы,
+    измененные с прошлой проверки, и сверяем их version с запомненной.
+    """
+
+    def __init__(self, client):
+        self._client = client  # gspread.Client: его сессия уже авторизована со scope drive
+        self._versions = {}    # {spreadsheet_id: version}
+        self._since = None     # modifiedTime последнего увиденного изменения (время сервера)
+
+    def _list_files(self, params, paginate=True):
+        files = []
+        while True:
+            response = self._client.request('get', DRIVE_FILES_URL, params=params).json()
+            files.extend(response.get('files', []))
+            if not paginate or not response.get('nextPageToken'):
+                return files
+            params = dict(params, pageToken=response['nextPageToken'])
+
+    def poll(self, watched_ids):
+        """Возвращает множество id из watched_ids, изменившихся с прошлого вызова
+
+        Блокирующий вызов, запускать в потоке.
+        """
+        params = {
+            'fields': 'nextPageToken, files(id, modifiedTime, version)',
+            'orderBy': 'modifiedTime desc',
+            'pageSize': 1000,
+            'supportsAllDrives': 'true',
+            'includeItemsFromAllDrives': 'true',
+        }
+        query = f"mimeType='{SPREADSHEET_MIME_TYPE}' and trashed=false"
+
+        if self._since is None:
+            # Первая проверка: только запоминаем точку отсчета по часам сервера
+            files = self._list_files(dict(params, q=query, pageSize=1), paginate=False)
+            if files:
+                self._since = files[0]['modifiedTime']
+            return set()
+
+        files = self._list_files(dict(params, q=f"{query} and modifiedTime >= '{self._since}'"))
+        changed = set()
+        for file in files:
+            self._since = max(self._since, file['modifiedTime'])
+            if self._versions.get(file['id']) == file.get('version'):
+                continue  # уже видели эту версию на границе интервала
+            self._versions[file['id']] = file.get('version')
+            if file['id'] in watched_ids:
+                changed.add(file['id'])
+        return changed
@@ -0,0 +1,74 @@
+import time
+
+ACCESS_OK = 'ok'
+ACCESS_DENIED = 'denied'
+
+
+class SpreadsheetInfo:
+    """Проверенные метаданные таблицы"""
+    __slots__ = ('id', 'title', 'worksheets', 'headers', 'access', 'checked_at')
+
+    def __init__(self, spreadsheet_id):
+        self.id = spreadsheet_id
+        self.title = None
+        self.worksheets = {}  # {worksheet_id: название вкладки}
+        self.headers = {}     # {worksheet_id: [заголовки]}
+        self.access = None
+        self.checked_at = 0.0
+
+
+class SpreadsheetRegistry:
+    """Реестр подключенных таблиц по каноническому ID
+
+    Когда ту же командную таблицу подключает очередной участник, доступ,
+    вкладки и заголовки уже известны, и ответ дается без обращений к API.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._items = {}  # {spreadsheet_id: SpreadsheetInfo}
+
+    def _info(self, spreadsheet_id):
+        info = self._items.get(spreadsheet_id)
+        if info is None:
+            info = self._items[spreadsheet_id] = SpreadsheetInfo(spreadsheet_id)
+        return info
+
+    def get(self, spreadsheet_id):
+        """Метаданные таблицы, если доступ подтвержден не дольше ttl назад"""
+        info = self._items.get(spreadsheet_id)
+        if info is None or info.access != ACCESS_OK or time.time() - info.checked_at > self.ttl:
+            return None
+        return info
+
+    def update(self, spreadsheet_id, title, worksheets):
+        """Запоминает результат проверки: название и вкладки [(id, название)]"""
+        info = self._info(spreadsheet_id)
+        info.title = title
+        info.worksheets = dict(worksheets)
+        info.access = ACCESS_OK
+        info.checked_at = time.time()
+        return info
+
+    def mark_denied(self, spreadsheet_id):
+        info = self._info(spreadsheet_id)
+        info.access = ACCESS_DENIED
+        info.checked_at = time.time()
+
+    def add_worksheet(self, spreadsheet_id, worksheet_id, title):
+        self._info(spreadsheet_id).worksheets[worksheet_id] = title
+
+    def find_worksheet(self, info, title, user_id=None):
+        """id вкладки с таким названием (для пользователя — по id в конце названия)"""
+        suffix = f"({user_id})" if user_id is not None else None
+        for worksheet_id, worksheet_title in info.worksheets.items():
+            if worksheet_title == title or (suffix and worksheet_title.endswith(suffix)):
+                return worksheet_id
+        return None
+
+    def headers(self, spreadsheet_id, worksheet_id):
+        info = self._items.get(spreadsheet_id)
+        return info.headers.get(worksheet_id) if info else None
+
+    def set_headers(self, spreadsheet_id, worksheet_id, headers):
+        self._info(spreadsheet_id).headers[worksheet_id] = headers
@@ -0,0 +1,147 @@
+import asyncio
+import json
+import logging
+import pickle
+import sqlite3
+import threading
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+logger = logging.getLogger(__name__)
+
+FLUSH_DELAY = 1.0  # секунд: изменения одного прохода PTB собираются в одну транзакцию
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversations (
+    name TEXT NOT NULL,
+    key TEXT NOT NULL,
+    state TEXT NOT NULL,
+    PRIMARY KEY (name, key)
+);
+CREATE TABLE IF NOT EXISTS user_data (
+    user_id INTEGER PRIMARY KEY,
+    data BLOB NOT NULL
+);
+"""
+
+
+class SQLitePersistence(BasePersistence):
+    """Хранит состояния разговоров и user_data построчно в SQLite
+
+    PTB передает только изменившиеся ключи; они копятся в памяти и пишутся
+    одной транзакцией в потоке, без перезаписи всего хранилища, как у
+    PicklePersistence. chat_data, bot_data и callback_data бот не использует.
+    """
+
+    def __init__(self, path, update_interval=60):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        self.path = path
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript(SCHEMA)
+        self._lock = threading.Lock()  # запись идет в потоке, соединение одно
+        self._conversation_writes = {}  # {(name, key): состояние или None для удаления}
+        self._user_data_writes = {}     # {user_id: данные или None для удаления}
+        self._flush_task = None
+
+    def _write(self, conversation_writes, user_data_writes):
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO conversations (name, key, state) VALUES (?, ?, ?)",
+                [(name, key, state) for (name, key), state in conversation_writes.items() if state is not None]
+            )
+            self._db.executemany(
+                "DELETE FROM conversations WHERE name = ? AND key = ?",
+                [(name, key) for (name, key), state in conversation_writes.items() if state is None]
+            )
+            self._db.executemany(
+                "INSERT OR REPLACE INTO user_data (user_id, data) VALUES (?, ?)",
+                [(user_id, data) for user_id, data in user_data_writes.items() if data is not None]
+            )
+            self._db.executemany(
+                "DELETE FROM user_data WHERE user_id = ?",
+                [(user_id,) for user_id, data in user_data_writes.items() if data is None]
+            )
+
+    def _take_writes(self):
+        writes = self._conversation_writes, self._user_data_writes
+        self._conversation_writes = {}
+        self._user_data_writes = {}
+        return writes
+
+    async def _flush_later(self):
+        await asyncio.sleep(FLUSH_DELAY)
+        self._flush_task = None
+        conversation_writes, user_data_writes = self._take_writes()
+        try:
+            await asyncio.to_thread(self._write, conversation_writes, user_data_writes)
+        except sqlite3.Error as e:
+            logger.error(f"Не удалось сохранить состояние разговоров: {e}")
+            # Вернем несохраненное, чтобы записать в следующий раз (новые изменения важнее)
+            self._conversation_writes = {**conversation_writes, **self._conversation_writes}
+            self._user_data_writes = {**user_data_writes, **self._user_data_writes}
+
+    def _mark_dirty(self):
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def get_conversations(self, name):
+        rows = self._db.execute("SELECT key, state FROM conversations WHERE name = ?", (name,)).fetchall()
+        return {tuple(json.loads(key)): json.loads(state) for key, state in rows}
+
+    async def update_conversation(self, name, key, new_state):
+        state = None if new_state is None else json.dumps(new_state)
+        self._conversation_writes[(name, json.dumps(list(key)))] = state
+        self._mark_dirty()
+
+    async def get_user_data(self):
+        rows = self._db.execute("SELECT user_id, data FROM user_data").fetchall()
+        return {user_id: pickle.loads(data) for user_id, data in rows}
+
+    async def update_user_data(self, user_id, data):
+        self._user_data_writes[user_id] = pickle.dumps(data) if data else None
+        self._mark_dirty()
+
+    async def drop_user_data(self, user_id):
+        self._user_data_writes[user_id] = None
+        self._mark_dirty()
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def get_chat_data(self):
+        return {}
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def get_bot_data(self):
+        return {}
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def flush(self):
+        """Остановка: дописывает все накопленное и закрывает базу"""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        self._write(*self._take_writes())
+        self._db.close()
@@ -0,0 +1,144 @@
+import asyncio
+import json
+import time
+import uuid
+from contextlib import asynccontextmanager
+from importlib.util import find_spec
+
+# redis — необязательная зависимость: нужна, только если реплик несколько
+REDIS_AVAILABLE = find_spec('redis') is not None
+LOCK_POLL_INTERVAL = 0.2  # секунд между попытками взять занятую блокировку
+
+
+class StaleStateError(Exception):
+    """Состояние пользователя успела изменить другая реплика"""
+
+
+class LockTimeoutError(Exception):
+    """Блокировку держит другая реплика дольше, чем готовы ждать"""
+
+
+class MemoryStateStore:
+    """Состояние пользователей в памяти процесса: одна реплика (по умолчанию)
+
+    Версии ведутся так же, как в общем хранилище, поэтому код бота не зависит
+    от того, сколько реплик запущено.
+    """
+    shared = False
+
+    def __init__(self):
+        self._items = {}  # {user_id: (версия, данные)}
+
+    async def load(self, user_id):
+        """(версия, данные) пользователя; (0, None), если состояния еще нет"""
+        return self._items.get(user_id, (0, None))
+
+    async def save(self, user_id, version, data):
+        """Записывает состояние, если оно не менялось с версии version; возвращает новую версию"""
+        if self._items.get(user_id, (0, None))[0] != version:
+            raise StaleStateError(user_id)
+        self._items[user_id] = (version + 1, data)
+        return version + 1
+
+    async def user_ids(self):
+        return list(self._items)
+
+    async def next_id(self, name):
+        """Общий для реплик номер; None — пусть считает сам процесс"""
+        return None
+
+    @asynccontextmanager
+    async def lock(self, name, ttl, wait):
+        """Блокировка, общая для реплик; в одном процессе хватает его собственных блокировок"""
+        yield
+
+    async def close(self):
+        pass
+
+
+class RedisStateStore:
+    """Состояние пользователей в Redis (или совместимом сервере), общее для реплик
+
+    Пользователь — хеш {version, data}. Запись идет через WATCH/MULTI:
+    если за время между чтением версии и записью ключ изменила другая
+    реплика, транзакция не выполнится и будет StaleStateError.
+    """
+    shared = True
+
+    def __init__(self, url, prefix='kplusbot'):
+        if not REDIS_AVAILABLE:
+            raise RuntimeError("Для STATE_BACKEND=redis установите пакет redis")
+        import redis.asyncio as aioredis
+        from redis.exceptions import WatchError
+        self._redis = aioredis.from_url(url, decode_responses=True)
+        self._watch_error = WatchError
+        self.prefix = prefix
+
+    def _key(self, user_id):
+        return f"{self.prefix}:user:{user_id}"
+
+    async def load(self, user_id):
+        version, data = await self._redis.hmget(self._key(user_id), 'version', 'data')
+        return int(version or 0), json.loads(data) if data else None
+
+    async def save(self, user_id, version, data):
+        key = self._key(user_id)
+        async with self._redis.pipeline(transaction=True) as pipe:
+            try:
+                await pipe.watch(key)
+                if int(await pipe.hget(key, 'version') or 0) != version:
+                    raise StaleStateError(user_id)
+                pipe.multi()
+                pipe.hset(key, mapping={'version': version + 1, 'data': json.dumps(data, ensure_ascii=False)})
+                await pipe.execute()
+            except self._watch_error:
+                raise StaleStateError(user_id)
+        return version + 1
+
+    async def user_ids(self):
+        prefix = f"{self.prefix}:user:"
+        return [int(key[len(prefix):]) async for key in self._redis.scan_iter(match=f"{prefix}*")]
+
+    async def next_id(self, name):
+        return await self._redis.incr(f"{self.prefix}:ids:{name}")
+
+    @asynccontextmanager
+    async def lock(self, name, ttl, wait):
+        """Блокировка, общая для реплик: SET NX с истечением через ttl секунд
+
+        Упавшая реплика держит ключ не дольше ttl. Если за wait секунд взять
+        блокировку не удалось — LockTimeoutError. Снимается только своя
+        блокировка (по случайному значению), без Lua: WATCH/MULTI, как в save.
+        """
+        key = f"{self.prefix}:lock:{name}"
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + wait
+        while not await self._redis.set(key, token, nx=True, px=int(ttl * 1000)):
+            if time.monotonic() >= deadline:
+                raise LockTimeoutError(name)
+            await asyncio.sleep(LOCK_POLL_INTERVAL)
+        try:
+            yield
+        finally:
+            async with self._redis.pipeline(transaction=True) as pipe:
+                try:
+                    await pipe.watch(key)
+                    if await pipe.get(key) == token:
+                        pipe.multi()
+                        pipe.delete(key)
+                        await pipe.execute()
+                except self._watch_error:
+                    pass  # ключ истек и его взяла другая реплика — это уже не наша блокировка
+
+    async def close(self):
+        # redis-py 5 переименовал close в aclose
+        await getattr(self._redis, 'aclose', self._redis.close)()
+
+
+def create_state_store(backend, url=None):
+    """Хранилище по настройке STATE_BACKEND: memory или redis"""
+    if backend == 'memory':
+        return MemoryStateStore()
+    if backend == 'redis':
+        return RedisStateStore(url)
+    raise ValueError(f"Неизвестный STATE_BACKEND: {backend}")
@@ -0,0 +1,97 @@
+import sys
+
+# Сколько разных строк тегов запоминать для повторного разбора
+PARSED_CACHE_SIZE = 4096
+
+
+def normalize_tag(raw):
+    """Ключ тега: без лишних пробелов, без учета регистра и ё/е"""
+    return ' '.join(raw.split()).casefold().replace('ё', 'е')
+
+
+def split_tags(text):
+    """Разбивает строку тегов на отдельные непустые теги"""
+    if not text:
+        return []
+    return [tag for tag in (' '.join(part.split()) for part in text.split(',')) if tag]
+
+
+class TagIndex:
+    """Словарь тегов пользователя: нормализованные ключи, целочисленные id и счетчики"""
+
+    def __init__(self):
+        self._ids = {}        # {нормализованный ключ: tag_id}
+        self._names = []      # tag_id -> отображаемое имя (первое встреченное написание)
+        self._counts = []     # tag_id -> число сохраненных задач с тегом
+        self._last_used = []  # tag_id -> момент последнего использования
+        self._clock = 0
+        self._parsed = {}     # {строка из таблицы: (tag_id, ...)}
+
+    def intern(self, raw):
+        """Возвращает id тега, заводя его при первом появлении"""
+        key = normalize_tag(raw)
+        if not key:
+            return None
+        tag_id = self._ids.get(key)
+        if tag_id is None:
+            tag_id = len(self._names)
+            self._ids[sys.intern(key)] = tag_id
+            self._names.append(sys.intern(' '.join(raw.split())))
+            self._counts.append(0)
+            self._last_used.append(0)
+        return tag_id
+
+    def ids_for(self, text):
+        """id тегов строки без дублей; разбор одной и той же строки кэшируется"""
+        ids = self._parsed.get(text)
+        if ids is None:
+            ids = tuple(dict.fromkeys(self.intern(tag) for tag in split_tags(text)))
+            if len(self._parsed) >= PARSED_CACHE_SIZE:
+                self._parsed.clear()
+            self._parsed[text] = ids
+        return ids
+
+    def name(self, tag_id):
+        return self._names[tag_id]
+
+    def known(self, tag_id):
+        """Есть ли тег с таким id (кнопка могла остаться от другой версии словаря)"""
+        return 0 <= tag_id < len(self._names)
+
+    def canonical(self, text):
+        """Приводит строку тегов к каноническому виду: 'Аналитика , аналитика' -> 'Аналитика'"""
+        return ', '.join(self._names[tag_id] for tag_id in self.ids_for(text))
+
+    def record(self, text):
+        """Учитывает использование тегов при сохранении задачи и возвращает каноническую строку"""
+        self._clock += 1
+        for tag_id in self.ids_for(text):
+            self._counts[tag_id] += 1
+            self._last_used[tag_id] = self._clock
+        return self.canonical(text)
+
+    def recent(self, limit=8):
+        """Последние использованные теги, при равенстве — самые частые: [(tag_id, имя)]"""
+        used = [tag_id for tag_id, count in enumerate(self._counts) if count]
+        used.sort(key=lambda tag_id: (self._last_used[tag_id], self._counts[tag_id]), reverse=True)
+        return [(tag_id, self._names[tag_id]) for tag_id in used[:limit]]
+
+    def to_dict(self):
+        """Словарь для сохранения: id тегов — позиции в списках, поэтому кнопки остаются верными"""
+        return {
+            'names': list(self._names),
+            'counts': list(self._counts),
+            'last_used': list(self._last_used),
+            'clock': self._clock
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        index = cls()
+        for tag_id, name in enumerate(data['names']):
+            index._ids[sys.intern(normalize_tag(name))] = tag_id
+            index._names.append(sys.intern(name))
+        index._counts = list(data['counts'])
+        index._last_used = list(data['last_used'])
+        index._clock = data['clock']
+        return index
@@ -0,0 +1,101 @@
+import itertools
+import json
+import os
+import sys
+import tempfile
+
+import rsa
+from telegram import Update
+from telegram.request import BaseRequest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# main.py читает настройки при импорте: подставляем тестовые до него.
+# Ключ сервисного аккаунта настоящий по формату, но запросов к Google тесты не делают.
+TEST_DIR = tempfile.mkdtemp(prefix='kplusbot-tests-')
+TEST_TOKEN = '123456:TEST-TOKEN'
+os.environ.setdefault('TELEGRAM_TOKEN', TEST_TOKEN)
+os.environ.setdefault('GOOGLE_CREDS_JSON', json.dumps({
+    'type': 'service_account',
+    'client_email': 'bot@test.iam.gserviceaccount.com',
+    'client_id': '1',
+    'private_key_id': 'test',
+    'private_key': rsa.newkeys(1024)[1].save_pkcs1().decode(),
+}))
+os.environ.setdefault('WEBHOOK_SECRET', 'test-secret')
+os.environ.setdefault('STATE_FILE', os.path.join(TEST_DIR, 'bot_state.json'))
+os.environ.setdefault('JOURNAL_FILE', os.path.join(TEST_DIR, 'journal.jsonl'))
+os.environ.setdefault('PERSISTENCE_FILE', os.path.join(TEST_DIR, 'bot_state.sqlite3'))
+
+BOT_USER = {'id': 123456, 'is_bot': True, 'first_name': 'Timetrack', 'username': 'timetrack_test_bot'}
+
+_update_ids = itertools.count(1)
+_message_ids = itertools.count(1000)
+
+
+class RecordingRequest(BaseRequest):
+    """Вместо Telegram: запоминает вызванные методы API и отвечает правдоподобным результатом"""
+
+    def __init__(self):
+        self.calls = []  # [(метод, параметры)]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        name = url.rsplit('/', 1)[-1]
+        params = request_data.parameters if request_data else {}
+        self.calls.append((name, params))
+        if name == 'getMe':
+            result = BOT_USER
+        elif name.startswith(('send', 'edit')) and 'chat_id' in params:
+            result = {
+                'message_id': params.get('message_id') or next(_message_ids),
+                'date': 0,
+                'chat': {'id': params['chat_id'], 'type': 'private'},
+                'text': params.get('text', ''),
+            }
+        else:
+            result = True
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+    def methods(self, since=0):
+        return [name for name, _ in self.calls[since:]]
+
+
+def user_json(user_id):
+    return {'id': user_id, 'is_bot': False, 'first_name': 'Тест', 'last_name': str(user_id)}
+
+
+def callback_update(bot, user_id, data):
+    """Нажатие кнопки под сообщением бота в личном чате"""
+    return Update.de_json({
+        'update_id': next(_update_ids),
+        'callback_query': {
+            'id': str(next(_update_ids)),
+            'from': user_json(user_id),
+            'chat_instance': str(user_id),
+            'data': data,
+            'message': {
+                'message_id': 1, 'date': 0, 'text': 'меню',
+                'chat': {'id': user_id, 'type': 'private'},
+                'from': BOT_USER,
+            },
+        },
+    }, bot)
+
+
+def message_update(bot, user_id, text):
+    """Текстовое сообщение (или команда) пользователя в личном чате"""
+    message = {
+        'message_id': next(_message_ids), 'date': 0, 'text': text,
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': user_json(user_id),
+    }
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return Update.de_json({'update_id': next(_update_ids), 'message': message}, bot)
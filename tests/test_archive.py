@@ -0,0 +1,132 @@
+"""Архивация: строки удаляются по содержимому, даже если лист сдвинулся во время записи архива"""
+from datetime import date
+
+import gspread
+import pytest
+
+import archive
+
+HEADER = ['Дата', 'Начало', 'Конец', 'Часы', 'Задача', 'Теги', 'Интервалы']
+OLD = 45000  # 2023-03-15 серийным номером Sheets
+NEW = 46300
+
+
+class FakeWorksheet:
+    """Вкладка в памяти: только то, что использует archive.py"""
+
+    def __init__(self, spreadsheet, worksheet_id, title, values):
+        self.spreadsheet = spreadsheet
+        self.id = worksheet_id
+        self.title = title
+        self.values = [list(row) for row in values]
+
+    def get_all_values(self, **kwargs):
+        return [list(row) for row in self.values]
+
+    def update(self, cell, rows):
+        self.values[:len(rows)] = [list(row) for row in rows]
+
+    def append_rows(self, rows, **kwargs):
+        self.values.extend(list(row) for row in rows)
+        self.spreadsheet.on_append(self)
+
+
+class FakeSpreadsheet:
+    def __init__(self):
+        self.worksheets = {}
+        self.on_append = lambda worksheet: None
+
+    def add(self, title, values):
+        worksheet = FakeWorksheet(self, len(self.worksheets) + 1, title, values)
+        self.worksheets[title] = worksheet
+        return worksheet
+
+    def worksheet(self, title):
+        try:
+            return self.worksheets[title]
+        except KeyError:
+            raise gspread.exceptions.WorksheetNotFound(title)
+
+    def add_worksheet(self, title, rows, cols):
+        return self.add(title, [])
+
+    def batch_update(self, body):
+        for request in body['requests']:
+            if 'deleteDimension' in request:
+                rows = request['deleteDimension']['range']
+                worksheet = next(ws for ws in self.worksheets.values() if ws.id == rows['sheetId'])
+                del worksheet.values[rows['startIndex']:rows['endIndex']]
+
+
+def row(day, task):
+    return [day, 0.375, 0.5, 3, task, '', '09:00-12:00']
+
+
+def test_rows_shifted_during_archive_write_are_found_by_content():
+    spreadsheet = FakeSpreadsheet()
+    worksheet = spreadsheet.add('Иван (1)', [HEADER, row(NEW, 'свежая'), row(OLD, 'старая 1'), row(OLD, 'старая 2')])
+
+    # Пока пишется архив, другая реплика вставляет задачу во вторую строку
+    def insert_live_row(target):
+        if target is not worksheet:
+            worksheet.values.insert(1, row(NEW, 'вставлена во время архивации'))
+    spreadsheet.on_append = insert_live_row
+
+    header, by_year = archive.archive_rows(spreadsheet, worksheet, date(2024, 1, 1))
+
+    assert [values[4] for values in worksheet.values[1:]] == ['вставлена во время архивации', 'свежая']
+    archived = spreadsheet.worksheet(archive.archive_title(worksheet.id, 2023))
+    assert [values[4] for values in archived.values[1:]] == ['старая 1', 'старая 2']
+    assert sum(len(rows) for rows in by_year.values()) == 2
+
+
+def test_locate_rows_counts_duplicates_and_ignores_trailing_blanks():
+    values = [HEADER, row(OLD, 'a') + [''], row(OLD, 'a'), row(OLD, 'a'), row(NEW, 'b')]
+    assert archive.locate_rows(values, [row(OLD, 'a'), row(OLD, 'a')]) == [2, 3]
+    assert archive.locate_rows(values, [row(OLD, 'c')]) == []
+
+
+def archived_tasks(spreadsheet, worksheet, year=2023):
+    return [values[4] for values in spreadsheet.worksheet(archive.archive_title(worksheet.id, year)).values[1:]]
+
+
+def test_rows_left_by_failed_delete_are_not_archived_twice():
+    spreadsheet = FakeSpreadsheet()
+    worksheet = spreadsheet.add('Иван (1)', [HEADER, row(NEW, 'свежая'), row(OLD, 'старая 1'), row(OLD, 'старая 2')])
+    batch_update = spreadsheet.batch_update
+
+    def fail_delete(body):
+        if any('deleteDimension' in request for request in body['requests']):
+            raise ConnectionError  # сбой между записью архива и удалением с листа
+        batch_update(body)
+    spreadsheet.batch_update = fail_delete
+    with pytest.raises(ConnectionError):
+        archive.archive_rows(spreadsheet, worksheet, date(2024, 1, 1))
+    assert archived_tasks(spreadsheet, worksheet) == ['старая 1', 'старая 2']
+
+    spreadsheet.batch_update = batch_update
+    header, by_year = archive.archive_rows(spreadsheet, worksheet, date(2024, 1, 1))
+    assert archived_tasks(spreadsheet, worksheet) == ['старая 1', 'старая 2']
+    assert [values[4] for values in worksheet.values[1:]] == ['свежая']
+    assert [values[4] for values in by_year[2023]] == ['старая 1', 'старая 2']
+
+
+def test_row_edited_during_archive_stays_and_leaves_no_copy():
+    spreadsheet = FakeSpreadsheet()
+    worksheet = spreadsheet.add('Иван (1)', [HEADER, row(OLD, 'старая 1'), row(OLD, 'старая 2')])
+
+    # Пока пишется архив, пользователь исправляет описание одной из строк
+    def edit_row(target):
+        if target is not worksheet:
+            worksheet.values[2][4] = 'старая 2 (исправлена)'
+    spreadsheet.on_append = edit_row
+
+    archive.archive_rows(spreadsheet, worksheet, date(2024, 1, 1))
+    assert [values[4] for values in worksheet.values[1:]] == ['старая 2 (исправлена)']
+    assert archived_tasks(spreadsheet, worksheet) == ['старая 1']
+
+    # Следующий проход переносит исправленную строку один раз
+    spreadsheet.on_append = lambda target: None
+    archive.archive_rows(spreadsheet, worksheet, date(2024, 1, 1))
+    assert worksheet.values[1:] == []
+    assert archived_tasks(spreadsheet, worksheet) == ['старая 1', 'старая 2 (исправлена)']
@@ -0,0 +1,120 @@
+"""Бюджет запросов к Telegram на нажатие кнопки: один answerCallbackQuery и не больше одной правки"""
+import asyncio
+import itertools
+from datetime import timedelta
+
+import pytest
+from telegram import Bot
+
+import main
+from conftest import TEST_TOKEN, RecordingRequest, callback_update, message_update
+
+MAX_REQUESTS_PER_PRESS = 2
+
+_user_ids = itertools.count(50_000)
+
+
+@pytest.fixture
+def recorder():
+    return RecordingRequest()
+
+
+@pytest.fixture
+def bot(recorder):
+    return Bot(TEST_TOKEN, request=recorder)
+
+
+@pytest.fixture
+def user_id(monkeypatch):
+    """Пользователь с подключенной вкладкой; запись и чтение таблицы подменены"""
+    user_id = next(_user_ids)
+    main.user_sheets[user_id] = {
+        'url': 'https://docs.google.com/spreadsheets/d/test', 'id': 'test',
+        'worksheet_id': user_id, 'worksheet_title': f'Тест ({user_id})'
+    }
+    monkeypatch.setattr(main, 'write_rows', lambda user_id, rows: None)
+    yield user_id
+    main.user_sheets.pop(user_id, None)
+    for timer in main.user_tasks.running(user_id):
+        main.user_tasks.remove(user_id, timer.id)
+
+
+async def press(recorder, handler, update):
+    """Вызывает обработчик нажатия и проверяет, сколько запросов к Telegram он сделал"""
+    since = len(recorder.calls)
+    result = await handler(update, None)
+    methods = recorder.methods(since)
+    assert methods.count('answerCallbackQuery') == 1, methods
+    assert methods.count('editMessageText') <= 1, methods
+    assert len(methods) <= MAX_REQUESTS_PER_PRESS, methods
+    return result
+
+
+async def say(recorder, handler, update):
+    """Текстовое сообщение: один ответ"""
+    since = len(recorder.calls)
+    result = await handler(update, None)
+    assert recorder.methods(since) == ['sendMessage']
+    return result
+
+
+def test_single_timer_flow(recorder, bot, user_id):
+    async def scenario():
+        assert await press(recorder, main.task_start, callback_update(bot, user_id, 'task_start')) == main.TASK_DESCRIPTION
+        await say(recorder, main.handle_task_description, message_update(bot, user_id, 'Отчет'))
+        # Описание есть, тегов нет — завершение спрашивает теги
+        assert await press(recorder, main.task_end, callback_update(bot, user_id, 'task_end')) == main.TASK_TAGS
+        await say(recorder, main.handle_task_tags, message_update(bot, user_id, 'аналитика'))
+        await press(recorder, main.confirm_end_task, callback_update(bot, user_id, 'confirm_end'))
+
+    asyncio.run(scenario())
+    assert user_id not in main.user_tasks
+    assert recorder.calls[-1][1]['text'].startswith('✅ Задача сохранена')
+
+
+def test_multiple_timers_flow(recorder, bot, user_id):
+    async def scenario():
+        for description in ('Первая', 'Вторая'):
+            await press(recorder, main.task_start, callback_update(bot, user_id, 'task_start'))
+            await say(recorder, main.handle_task_description, message_update(bot, user_id, description))
+            main.user_tasks.current(user_id).tags = 'логи'
+
+        # Несколько таймеров — выбор из списка, затем сохранение выбранного
+        await press(recorder, main.task_end, callback_update(bot, user_id, 'task_end'))
+        first = main.user_tasks.running(user_id)[0]
+        await press(recorder, main.timer_selected, callback_update(bot, user_id, f'timer_end:{first.id}'))
+
+        # Повторное нажатие на уже завершенный таймер
+        await press(recorder, main.timer_selected, callback_update(bot, user_id, f'timer_end:{first.id}'))
+
+    asyncio.run(scenario())
+    assert len(main.user_tasks.running(user_id)) == 1
+
+
+def test_cancel_end(recorder, bot, user_id):
+    async def scenario():
+        await press(recorder, main.task_start, callback_update(bot, user_id, 'task_start'))
+        await press(recorder, main.confirm_end_task, callback_update(bot, user_id, 'cancel_end'))
+
+    asyncio.run(scenario())
+    assert user_id in main.user_tasks
+
+
+def test_report_week(recorder, bot, user_id, monkeypatch):
+    reads = []
+
+    def fetch_period_records(spreadsheet_id, worksheet_id, start_date, end_date):
+        reads.append(worksheet_id)
+        return [{'Дата': end_date.isoformat(), 'Часы': 1.5, 'Задача': 'Отчет', 'Теги': 'аналитика'},
+                {'Дата': (end_date - timedelta(days=1)).isoformat(), 'Часы': 2, 'Задача': 'Код', 'Теги': ''}]
+
+    monkeypatch.setattr(main, 'fetch_period_records', fetch_period_records)
+
+    async def scenario():
+        await press(recorder, main.report_week, callback_update(bot, user_id, 'report_week'))
+        # Второе нажатие отдается из кэша отчетов
+        await press(recorder, main.report_week, callback_update(bot, user_id, 'report_week'))
+
+    asyncio.run(scenario())
+    assert reads == [user_id]
+    assert 'Всего времени: 3.5 ч' in recorder.calls[-1][1]['text']
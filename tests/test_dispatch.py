@@ -0,0 +1,173 @@
+"""Маршрутизация обновлений в собранном приложении: нажатия доходят до диалогов, а не до кнопки без шаблона"""
+import asyncio
+import itertools
+import json
+
+import pytest
+from telegram.ext import ApplicationBuilder, ConversationHandler
+
+import main
+from conftest import TEST_TOKEN, RecordingRequest, callback_update, message_update
+
+_user_ids = itertools.count(60_000)
+
+
+@pytest.fixture
+def recorder():
+    return RecordingRequest()
+
+
+@pytest.fixture
+def application(recorder, tmp_path, monkeypatch):
+    monkeypatch.setattr(main, 'PERSISTENCE_FILE', str(tmp_path / 'conversations.sqlite3'))
+    return main.build_application(ApplicationBuilder().token(TEST_TOKEN).request(recorder))
+
+
+@pytest.fixture
+def written(monkeypatch):
+    """Строки, которые бот записал бы в таблицу: {user_id: [строки]}"""
+    written = {}
+    monkeypatch.setattr(main, 'write_rows', lambda user_id, rows: written.setdefault(user_id, []).extend(rows))
+    return written
+
+
+@pytest.fixture
+def user_id():
+    user_id = next(_user_ids)
+    main.user_sheets[user_id] = {
+        'url': 'https://docs.google.com/spreadsheets/d/test', 'id': 'test',
+        'worksheet_id': user_id, 'worksheet_title': f'Тест ({user_id})'
+    }
+    yield user_id
+    main.user_sheets.pop(user_id, None)
+    for timer in main.user_tasks.running(user_id):
+        main.user_tasks.remove(user_id, timer.id)
+
+
+def first_handler(application, update):
+    """Обработчик группы 0, который PTB выберет для обновления"""
+    return next(handler for handler in application.handlers[0] if handler.check_update(update))
+
+
+def conversation(application, name):
+    return next(
+        handler for handler in application.handlers[0]
+        if isinstance(handler, ConversationHandler) and handler.name == name
+    )
+
+
+def last_text(recorder):
+    return next(params['text'] for _, params in reversed(recorder.calls) if 'text' in params)
+
+
+def test_task_buttons_enter_task_conversation(application, user_id):
+    task_conv = conversation(application, 'task')
+    for data in ('task_start', 'task_end', 'timer_end:7'):
+        assert first_handler(application, callback_update(application.bot, user_id, data)) is task_conv, data
+
+
+def test_task_flow_saves_row(application, recorder, user_id, written):
+    bot = application.bot
+
+    async def scenario():
+        async with application:
+            await application.process_update(callback_update(bot, user_id, 'task_start'))
+            await application.process_update(message_update(bot, user_id, 'Отчет по логам'))
+            assert main.user_tasks.current(user_id).description == 'Отчет по логам'
+
+            await application.process_update(callback_update(bot, user_id, 'task_end'))
+            await application.process_update(message_update(bot, user_id, 'Аналитика, логи'))
+            assert last_text(recorder).endswith('Завершить задачу?')
+            await application.process_update(callback_update(bot, user_id, 'confirm_end'))
+
+    asyncio.run(scenario())
+    assert [row['Задача'] for row in written[user_id]] == ['Отчет по логам']
+    assert written[user_id][0]['Теги'] == 'Аналитика, логи'
+    assert user_id not in main.user_tasks
+
+
+def test_reminder_and_tag_buttons(application, recorder, user_id, written):
+    bot = application.bot
+    main.get_tag_index(user_id).record('аналитика')
+
+    async def scenario():
+        async with application:
+            await application.process_update(callback_update(bot, user_id, 'task_start'))
+            await application.process_update(message_update(bot, user_id, 'Созвон'))
+            timer = main.user_tasks.current(user_id)
+
+            # Кнопка «Завершить» из напоминания простоя
+            await application.process_update(callback_update(bot, user_id, f'timer_end:{timer.id}'))
+            await application.process_update(callback_update(bot, user_id, 'tag:0'))
+            assert timer.tags == 'аналитика'
+            # Кнопка из старого сообщения с неизвестным id тега
+            await application.process_update(callback_update(bot, user_id, 'tag:99'))
+            await application.process_update(callback_update(bot, user_id, 'tags_done'))
+            await application.process_update(callback_update(bot, user_id, 'confirm_end'))
+
+    asyncio.run(scenario())
+    assert [(row['Задача'], row['Теги']) for row in written[user_id]] == [('Созвон', 'аналитика')]
+
+
+def test_skip_tags(application, user_id, written):
+    bot = application.bot
+
+    async def scenario():
+        async with application:
+            await application.process_update(callback_update(bot, user_id, 'task_start'))
+            await application.process_update(message_update(bot, user_id, 'Код'))
+            await application.process_update(callback_update(bot, user_id, 'task_end'))
+            await application.process_update(callback_update(bot, user_id, 'skip_tags'))
+
+    asyncio.run(scenario())
+    assert [(row['Задача'], row['Теги']) for row in written[user_id]] == [('Код', '')]
+
+
+def test_start_binds_sheet(application, recorder):
+    bot = application.bot
+    user_id = next(_user_ids)
+    # Таблица уже проверена для другого участника — подключение идет без запросов к Google
+    title = f"Тест {user_id} ({user_id})"
+    info = main.sheet_registry.update('sheet-abc', 'Учет времени', [(42, title)])
+    main.sheet_registry.set_headers(info.id, 42, list(main.REQUIRED_HEADERS))
+
+    async def scenario():
+        async with application:
+            await application.process_update(message_update(bot, user_id, '/start'))
+            assert 'Пришлите ссылку' in last_text(recorder)
+            await application.process_update(
+                message_update(bot, user_id, 'https://docs.google.com/spreadsheets/d/sheet-abc/edit')
+            )
+
+    try:
+        asyncio.run(scenario())
+        assert main.user_sheets[user_id]['id'] == 'sheet-abc'
+        assert main.user_sheets[user_id]['worksheet_id'] == 42
+        assert last_text(recorder).startswith('✅ Успешно подключено')
+    finally:
+        main.user_sheets.pop(user_id, None)
+
+
+def test_state_file_follows_changes(application, user_id, written):
+    """Файл состояния переписывается после каждого обновления, а не только при остановке"""
+    bot = application.bot
+
+    def timers_in_file():
+        with open(main.STATE_FILE, encoding='utf-8') as f:
+            return [timer['id'] for timer in json.load(f)['timers'] if timer['user_id'] == user_id]
+
+    async def scenario():
+        async with application:
+            await application.process_update(callback_update(bot, user_id, 'task_start'))
+            timer = main.user_tasks.current(user_id)
+            assert timers_in_file() == [timer.id]
+            await application.process_update(message_update(bot, user_id, 'Код'))
+            await application.process_update(callback_update(bot, user_id, 'task_end'))
+            await application.process_update(callback_update(bot, user_id, 'skip_tags'))
+            # Процесс упадет сразу после сохранения — при запуске таймер не вернется,
+            # а новые id продолжат счетчик, а не начнутся с 1
+            assert timers_in_file() == []
+            with open(main.STATE_FILE, encoding='utf-8') as f:
+                assert json.load(f)['next_timer_id'] > timer.id
+
+    asyncio.run(scenario())
@@ -0,0 +1,53 @@
+"""Импорт CSV и подготовка строк к записи с USER_ENTERED: формулы не попадают в таблицу"""
+import csv
+import io
+
+import importer
+from row_parser import sheet_row
+
+HEADERS = ['Дата', 'Начало', 'Конец', 'Часы', 'Задача', 'Теги', 'Интервалы']
+FORMULA = '=IMPORTXML("http://x";"//a")'
+
+
+def import_rows(records):
+    text = io.StringIO()
+    csv.writer(text).writerows(records)
+    text.seek(0)
+    return list(importer.read_import_rows(csv.reader(text), lambda tags: tags))
+
+
+def test_start_and_end_must_be_times():
+    results = import_rows([
+        ['Дата', 'Начало', 'Конец', 'Часы', 'Задача'],
+        ['17.10.2026', '9:05', '12:30', '3.4', 'Отчет'],
+        ['17.10.2026', FORMULA, '12:30', '1', 'Отчет'],
+        ['17.10.2026', '10:00', '=1+1', '1', 'Отчет'],
+        ['17.10.2026', '', '', '1', 'Без времени'],
+    ])
+    assert results[0] == ('row', {
+        'Дата': '2026-10-17', 'Начало': '09:05:00', 'Конец': '12:30:00', 'Часы': 3.4, 'Задача': 'Отчет', 'Теги': ''
+    })
+    assert [result[:2] for result in results[1:3]] == [('error', 3), ('error', 4)]
+    assert results[3][0] == 'row' and results[3][1]['Начало'] == ''
+
+
+def test_hours_must_be_positive_and_fit_in_a_day():
+    results = import_rows([
+        ['Дата', 'Часы', 'Задача'],
+        ['17.10.2026', '-2', 'Отчет'],
+        ['17.10.2026', '0', 'Отчет'],
+        ['17.10.2026', '25', 'Отчет'],
+        ['17.10.2026', '24', 'Отчет'],
+        ['17.10.2026', '0:30', 'Отчет'],
+    ])
+    assert [result[:2] for result in results[:3]] == [('error', 2), ('error', 3), ('error', 4)]
+    assert 'больше 0' in results[0][2]
+    assert [result[1]['Часы'] for result in results[3:]] == [24, 0.5]
+
+
+def test_sheet_row_writes_only_well_formed_dates_and_times_as_values():
+    row = sheet_row(HEADERS, {
+        'Дата': '2026-10-17', 'Начало': FORMULA, 'Конец': '12:30:00', 'Часы': '1,5',
+        'Задача': '=HYPERLINK("x")', 'Теги': 'логи', 'Интервалы': '09:00-10:30'
+    })
+    assert row == ['2026-10-17', "'" + FORMULA, '12:30:00', 1.5, "'=HYPERLINK(\"x\")", "'логи", "'09:00-10:30"]
@@ -0,0 +1,160 @@
+"""Общее состояние реплик на локальном заменителе Redis (fakeredis)"""
+import asyncio
+import itertools
+
+import pytest
+from telegram import Bot
+from telegram.ext import ApplicationBuilder
+
+import main
+from conftest import TEST_TOKEN, RecordingRequest, callback_update, message_update
+from state_store import LockTimeoutError, RedisStateStore, StaleStateError
+
+fakeredis = pytest.importorskip('fakeredis')
+
+_user_ids = itertools.count(70_000)
+
+
+@pytest.fixture
+def server(monkeypatch):
+    """Один сервер на все хранилища теста: каждое хранилище — как отдельная реплика"""
+    import redis.asyncio
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(
+        redis.asyncio, 'from_url', lambda url, **kwargs: fakeredis.FakeAsyncRedis(server=server, **kwargs)
+    )
+    return server
+
+
+@pytest.fixture
+def shared_store(server, monkeypatch):
+    store = RedisStateStore('redis://stand-in')
+    monkeypatch.setattr(main, 'state_store', store)
+    return store
+
+
+@pytest.fixture
+def user_id():
+    user_id = next(_user_ids)
+    main.user_sheets[user_id] = {
+        'url': 'https://docs.google.com/spreadsheets/d/test', 'id': 'test',
+        'worksheet_id': user_id, 'worksheet_title': f'Тест ({user_id})'
+    }
+    yield user_id
+    forget_locally(user_id)
+
+
+def forget_locally(user_id):
+    """Состояние пользователя пропадает из памяти процесса — как будто это другая реплика"""
+    main.user_sheets.pop(user_id, None)
+    for timer in main.user_tasks.running(user_id):
+        main.user_tasks.remove(user_id, timer.id)
+    main.user_versions.pop(user_id, None)
+    main.saved_states.pop(user_id, None)
+    main.tag_indexes.pop(user_id, None)
+    main.apply_conversations(user_id, {})
+
+
+def test_compare_and_set(server):
+    async def scenario():
+        replica_a = RedisStateStore('redis://stand-in')
+        replica_b = RedisStateStore('redis://stand-in')
+        assert await replica_a.load(1) == (0, None)
+        assert await replica_a.save(1, 0, {'n': 1}) == 1
+        # Вторая реплика пишет поверх версии, которую уже сменили
+        with pytest.raises(StaleStateError):
+            await replica_b.save(1, 0, {'n': 2})
+        assert await replica_b.load(1) == (1, {'n': 1})
+        assert await replica_b.save(1, 1, {'n': 2}) == 2
+        assert await replica_a.user_ids() == [1]
+        assert [await replica_a.next_id('timer'), await replica_b.next_id('timer')] == [1, 2]
+        await replica_a.close()
+        await replica_b.close()
+
+    asyncio.run(scenario())
+
+
+def test_sheet_lock_is_shared_by_replicas(server):
+    async def scenario():
+        replica_a = RedisStateStore('redis://stand-in')
+        replica_b = RedisStateStore('redis://stand-in')
+        async with replica_a.lock('sheet:test:1', ttl=30, wait=1):
+            # Пока одна реплика архивирует вкладку, другая в нее не пишет
+            with pytest.raises(LockTimeoutError):
+                async with replica_b.lock('sheet:test:1', ttl=30, wait=0.3):
+                    pass
+            async with replica_b.lock('sheet:test:2', ttl=30, wait=0):
+                pass
+        async with replica_b.lock('sheet:test:1', ttl=30, wait=0):
+            pass
+        await replica_a.close()
+        await replica_b.close()
+
+    asyncio.run(scenario())
+
+
+def test_claim_timer_once_across_replicas(shared_store, user_id):
+    async def scenario():
+        first = main.user_tasks.start(user_id, main.utc_now(), await shared_store.next_id('timer'))
+        second = main.user_tasks.start(user_id, main.utc_now(), await shared_store.next_id('timer'))
+        await main.save_user_state(user_id)
+
+        # Другая реплика уже завершила первый таймер
+        replica_b = RedisStateStore('redis://stand-in')
+        version, state = await replica_b.load(user_id)
+        state['timers'] = [timer for timer in state['timers'] if timer['id'] != first.id]
+        await replica_b.save(user_id, version, state)
+
+        assert await main.claim_timer(user_id, first.id) is None
+        assert (await main.claim_timer(user_id, second.id)).id == second.id
+        version, state = await replica_b.load(user_id)
+        assert state['timers'] == []
+
+    asyncio.run(scenario())
+    assert user_id not in main.user_tasks
+
+
+def test_end_task_saves_the_claimed_version(shared_store, user_id, monkeypatch):
+    written = []
+    monkeypatch.setattr(main, 'write_rows', lambda user_id, rows: written.extend(rows))
+    bot = Bot(TEST_TOKEN, request=RecordingRequest())
+
+    async def scenario():
+        timer = main.user_tasks.start(user_id, main.utc_now(), await shared_store.next_id('timer'))
+        timer.description = 'Ревью'
+        await main.save_user_state(user_id)
+
+        # Пока эта реплика готовится сохранить задачу, другая уточняет описание
+        replica_b = RedisStateStore('redis://stand-in')
+        version, state = await replica_b.load(user_id)
+        state['timers'][0]['description'] = 'Ревью кода'
+        await replica_b.save(user_id, version, state)
+
+        await main.end_task(callback_update(bot, user_id, 'confirm_end'), None)
+
+    asyncio.run(scenario())
+    assert [row['Задача'] for row in written] == ['Ревью кода']
+
+
+def test_task_flow_continues_on_another_replica(shared_store, user_id, tmp_path, monkeypatch):
+    monkeypatch.setattr(main, 'PERSISTENCE_FILE', str(tmp_path / 'conversations.sqlite3'))
+    written = []
+    monkeypatch.setattr(main, 'write_rows', lambda user_id, rows: written.extend(rows))
+    application = main.build_application(ApplicationBuilder().token(TEST_TOKEN).request(RecordingRequest()))
+    bot = application.bot
+    sheet = dict(main.user_sheets[user_id])
+
+    async def scenario():
+        async with application:
+            await application.process_update(callback_update(bot, user_id, 'task_start'))
+            # Следующие обновления пришли на реплику, которая этого пользователя не видела
+            forget_locally(user_id)
+            await application.process_update(message_update(bot, user_id, 'Ревью'))
+            assert main.user_sheets[user_id] == sheet
+            forget_locally(user_id)
+            await application.process_update(message_update(bot, user_id, 'код'))
+            forget_locally(user_id)
+            await application.process_update(callback_update(bot, user_id, 'confirm_end'))
+
+    asyncio.run(scenario())
+    assert [(row['Задача'], row['Теги']) for row in written] == [('Ревью', 'код')]
@@ -0,0 +1,72 @@
+from datetime import datetime, timedelta, timezone
+
+from timers import IDLE_REMIND, IDLE_STALE, Timer, TimerRegistry
+
+START = datetime(2026, 10, 1, 9, 0, tzinfo=timezone.utc)
+LATER = (START + timedelta(days=1)).timestamp()
+LATER_START = START + timedelta(days=1)
+
+
+def make_registry():
+    return TimerRegistry(remind_after=3600, stale_after=12 * 3600)
+
+
+def test_reloading_same_state_does_not_duplicate_idle_checks():
+    registry = make_registry()
+    timer = registry.start(1, START)
+    snapshot = [timer.to_dict()]
+    for _ in range(3):
+        registry.replace_user(1, snapshot, timer.id)
+
+    assert [(due.id, stage) for due, stage in registry.pop_idle(LATER)] == [(timer.id, IDLE_REMIND)]
+    assert registry.pop_idle(LATER) == []
+
+
+def test_reminded_timer_is_not_reminded_again_after_reload():
+    registry = make_registry()
+    registry.start(1, START)
+    [(due, stage)] = registry.pop_idle(START.timestamp() + 3600)
+    assert stage == IDLE_REMIND
+    due.reminded = due.intervals[-1]
+    registry.schedule_idle(due, IDLE_STALE)
+
+    # Другая реплика (или перезапуск) загружает то же состояние с отметкой напоминания
+    registry.replace_user(1, [due.to_dict()], due.id)
+    assert [stage for _, stage in registry.pop_idle(LATER)] == [IDLE_STALE]
+
+
+def test_replace_user_takes_current_timer_from_state():
+    registry = make_registry()
+    first = registry.start(1, START)
+    second = registry.start(1, START + timedelta(minutes=5))
+    registry.replace_user(1, [first.to_dict(), second.to_dict()], first.id)
+    assert registry.current(1).id == first.id
+    registry.replace_user(1, [first.to_dict(), second.to_dict()], None)
+    assert registry.current_id(1) is None
+
+
+def test_pause_and_resume_reschedule():
+    registry = make_registry()
+    timer = registry.start(1, START)
+    registry.pause(1, timer.id, START + timedelta(minutes=30))
+    registry.resume(1, timer.id, START + timedelta(hours=2))
+    # Напоминание считается от продолжения, старые записи кучи отброшены
+    assert registry.pop_idle(START.timestamp() + 2 * 3600 + 3599) == []
+    assert [stage for _, stage in registry.pop_idle(LATER)] == [IDLE_REMIND]
+
+
+def test_timer_round_trip_keeps_reminder_mark():
+    timer = Timer(5, 1, START)
+    timer.reminded = timer.intervals[-1]
+    assert Timer.from_dict(timer.to_dict()).reminded == timer.reminded
+
+
+def test_ids_continue_after_restart_without_timers():
+    registry = make_registry()
+    timer = registry.start(1, START)
+    registry.remove(1, timer.id)
+    # Перезапуск: таймеров нет, но счетчик сохранен — старая кнопка timer_end:1 не найдет новый таймер
+    restarted = make_registry()
+    restarted.restore(registry.snapshot())
+    restarted.skip_ids(registry.next_id)
+    assert restarted.start(1, LATER_START).id == timer.id + 1
@@ -0,0 +1,80 @@
+"""Вебхук: проверка секрета, некорректные тела и лимит отклонений по IP"""
+import asyncio
+
+from aiohttp.test_utils import TestClient, TestServer
+from telegram.ext import ApplicationBuilder
+
+from conftest import TEST_TOKEN, RecordingRequest
+from dedupe import UpdateDeduplicator
+from health import HealthProbes
+from webhook_server import IP_BURST, SECRET_HEADER, create_web_app
+
+SECRET = 'webhook-secret'
+OTHER_IP = '203.0.113.5'
+
+
+def make_app(trust_proxy):
+    application = ApplicationBuilder().token(TEST_TOKEN).request(RecordingRequest()).build()
+    web_app = create_web_app(
+        application, '/telegram', SECRET, HealthProbes(max_age=60), lambda: {}, UpdateDeduplicator(),
+        trust_proxy=trust_proxy
+    )
+    return application, web_app
+
+
+def run(scenario, trust_proxy=True):
+    application, web_app = make_app(trust_proxy)
+
+    async def main():
+        async with TestClient(TestServer(web_app)) as client:
+            await scenario(application, client)
+
+    asyncio.run(main())
+
+
+def post(client, body, ip=OTHER_IP, secret=SECRET):
+    return client.post('/telegram', json=body, headers={SECRET_HEADER: secret, 'X-Forwarded-For': ip})
+
+
+def test_update_is_queued_once():
+    async def scenario(application, client):
+        update = {'update_id': 1, 'message': {
+            'message_id': 1, 'date': 0, 'text': 'hi', 'chat': {'id': 5, 'type': 'private'}
+        }}
+        assert (await post(client, update)).status == 200
+        assert (await post(client, update)).status == 200  # повторная доставка
+        assert application.update_queue.qsize() == 1
+
+    run(scenario)
+
+
+def test_bodies_that_are_not_updates_get_400():
+    async def scenario(application, client):
+        for body in ([1], {'foo': 1}, {'update_id': 'x'}, {'update_id': 2, 'message': 5}):
+            assert (await post(client, body)).status == 400, body
+        assert application.update_queue.qsize() == 0
+
+    run(scenario)
+
+
+def test_wrong_secret_is_limited_but_updates_pass():
+    async def scenario(application, client):
+        for _ in range(IP_BURST):
+            assert (await post(client, {'update_id': 3}, secret='old')).status == 403
+        assert (await post(client, {'update_id': 3}, secret='old')).status == 429
+
+        # Адрес исчерпал лимит (например, общий адрес прокси), но обновление с верным секретом проходит
+        assert (await post(client, {'update_id': 4})).status == 200
+        assert application.update_queue.qsize() == 1
+
+    run(scenario)
+
+
+def test_forwarded_for_is_ignored_without_proxy():
+    async def scenario(application, client):
+        # Без прокси подставленный X-Forwarded-For не дает обойти лимит сменой адреса
+        for n in range(IP_BURST):
+            assert (await post(client, {'update_id': 5}, ip=f'203.0.113.{n}', secret='old')).status == 403
+        assert (await post(client, {'update_id': 5}, ip='198.51.100.1', secret='old')).status == 429
+
+    run(scenario, trust_proxy=False)
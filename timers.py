@@ -0,0 +1,263 @@
+import heapq
+from array import array
+from datetime import datetime, time, timedelta, timezone
+
+
+class Timer:
+    """Запущенный таймер задачи"""
+    __slots__ = ('id', 'user_id', 'start_time', 'description', 'tags', 'intervals', 'reminded')
+
+    def __init__(self, timer_id, user_id, start_time):
+        self.id = timer_id
+        self.user_id = user_id
+        self.start_time = start_time
+        self.description = None
+        self.tags = None
+        # Плоский массив timestamp'ов: начало, конец, начало, ...; нечётная длина — таймер идёт
+        self.intervals = array('d', [start_time.timestamp()])
+        self.reminded = None  # отметка интервала, о простое которого уже напомнили
+
+    @property
+    def paused(self):
+        return len(self.intervals) % 2 == 0
+
+    def pause(self, now):
+        """Закрывает текущий интервал; возвращает False, если таймер уже на паузе"""
+        if self.paused:
+            return False
+        self.intervals.append(now.timestamp())
+        return True
+
+    def resume(self, now):
+        """Открывает новый интервал; возвращает False, если таймер уже идёт"""
+        if not self.paused:
+            return False
+        self.intervals.append(now.timestamp())
+        return True
+
+    def closed_intervals(self, end_time):
+        """Пары (начало, конец) в UTC; открытый интервал закрывается в end_time"""
+        stamps = list(self.intervals)
+        if not self.paused:
+            stamps.append(end_time.timestamp())
+        return [
+            (datetime.fromtimestamp(stamps[i], timezone.utc), datetime.fromtimestamp(stamps[i + 1], timezone.utc))
+            for i in range(0, len(stamps), 2)
+        ]
+
+    def duration(self, end_time):
+        """Чистое время работы в секундах без учета пауз"""
+        stamps = self.intervals
+        total = sum(stamps[i + 1] - stamps[i] for i in range(0, len(stamps) - 1, 2))
+        if not self.paused:
+            total += end_time.timestamp() - stamps[-1]
+        return total
+
+    def to_dict(self):
+        """Состояние таймера для сохранения на диск"""
+        return {
+            'id': self.id,
+            'user_id': self.user_id,
+            'description': self.description,
+            'tags': self.tags,
+            'intervals': list(self.intervals),
+            'reminded': self.reminded
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        timer = cls(data['id'], data['user_id'], datetime.fromtimestamp(data['intervals'][0], timezone.utc))
+        timer.description = data['description']
+        timer.tags = data['tags']
+        timer.intervals = array('d', data['intervals'])
+        timer.reminded = data.get('reminded')
+        return timer
+
+    def label(self, zone, max_len=30):
+        """Короткая подпись таймера для кнопки; время начала — в поясе пользователя"""
+        description = self.description or 'без описания'
+        if len(description) > max_len:
+            description = description[:max_len] + '...'
+        state = "⏸ " if self.paused else ""
+        return f"{state}#{self.id} {description} (с {self.start_time.astimezone(zone).strftime('%H:%M')})"
+
+
+def format_intervals(intervals):
+    """Компактная запись интервалов для таблицы: 09:00-12:30;13:15-17:00"""
+    return ';'.join(f"{start:%H:%M}-{end:%H:%M}" for start, end in intervals)
+
+
+def split_by_day(intervals, zone):
+    """Переводит интервалы в пояс zone и режет их по полуночи: {дата: [(начало, конец)]}"""
+    days = {}
+    for start, end in intervals:
+        start = start.astimezone(zone)
+        end = end.astimezone(zone)
+        while start.date() < end.date():
+            midnight = zone.localize(datetime.combine(start.date() + timedelta(days=1), time()))
+            days.setdefault(start.date(), []).append((start, midnight))
+            start = midnight
+        if end > start:
+            days.setdefault(start.date(), []).append((start, end))
+    if not days:
+        # Таймер закрыт сразу после запуска — одна пустая строка на день начала
+        start = intervals[0][0].astimezone(zone)
+        days[start.date()] = [(start, start)]
+    return days
+
+
+# Стадии проверки простаивающих таймеров
+IDLE_REMIND = 'remind'
+IDLE_STALE = 'stale'
+
+
+class TimerRegistry:
+    """Таймеры пользователей, проиндексированные по пользователю и по id таймера"""
+
+    def __init__(self, remind_after=None, stale_after=None):
+        self.next_id = 1    # следующий свой id; сохраняется между запусками (skip_ids)
+        self._by_id = {}    # {timer_id: Timer}
+        self._by_user = {}  # {user_id: {timer_id: Timer}}
+        self._current = {}  # {user_id: timer_id} — таймер, с которым идёт диалог
+        # Пороги простоя в секундах (None — не отслеживать)
+        self._idle_after = {IDLE_REMIND: remind_after, IDLE_STALE: stale_after}
+        # Мин-куча (срок, timer_id, последняя отметка, стадия); устаревшие записи удаляются лениво
+        self._idle = []
+        self._scheduled = {}  # {timer_id: (отметка, стадия)} — действующая запись кучи таймера
+
+    def start(self, user_id, start_time, timer_id=None):
+        """Запускает новый таймер и делает его текущим
+
+        timer_id выдает общее хранилище, когда реплик несколько; иначе свой счетчик.
+        """
+        if timer_id is None:
+            timer_id = self.next_id
+        self.skip_ids(timer_id + 1)
+        timer = Timer(timer_id, user_id, start_time)
+        self._by_id[timer.id] = timer
+        self._by_user.setdefault(user_id, {})[timer.id] = timer
+        self._current[user_id] = timer.id
+        self.schedule_idle(timer, IDLE_REMIND)
+        return timer
+
+    def pause(self, user_id, timer_id, now):
+        timer = self.get(user_id, timer_id)
+        if timer is None or not timer.pause(now):
+            return None
+        # На паузе напоминать не о чем, но брошенный таймер всё равно надо убрать
+        self.schedule_idle(timer, IDLE_STALE)
+        return timer
+
+    def resume(self, user_id, timer_id, now):
+        timer = self.get(user_id, timer_id)
+        if timer is None or not timer.resume(now):
+            return None
+        self.schedule_idle(timer, IDLE_REMIND)
+        return timer
+
+    def snapshot(self):
+        """Все таймеры в виде словарей для сохранения при остановке"""
+        return [timer.to_dict() for timer in self._by_id.values()]
+
+    def restore(self, items):
+        """Возвращает в реестр таймеры из snapshot(), сохраняя их id"""
+        for data in items:
+            timer = Timer.from_dict(data)
+            self._by_id[timer.id] = timer
+            self._by_user.setdefault(timer.user_id, {})[timer.id] = timer
+            # Повторная загрузка того же состояния запись в куче не дублирует (см. schedule_idle)
+            reminded = timer.paused or timer.reminded == timer.intervals[-1]
+            self.schedule_idle(timer, IDLE_STALE if reminded else IDLE_REMIND)
+        if self._by_id:
+            self.skip_ids(max(self._by_id) + 1)
+
+    def skip_ids(self, next_id):
+        """Не выдавать id меньше next_id: кнопки сообщений прошлого запуска не попадут в новый таймер"""
+        self.next_id = max(self.next_id, next_id)
+
+    def replace_user(self, user_id, items, current=None):
+        """Заменяет таймеры пользователя версией из общего хранилища
+
+        current — текущий таймер диалога из того же состояния.
+        """
+        for timer in self.running(user_id):
+            self.remove(user_id, timer.id)
+        self._current.pop(user_id, None)
+        self.restore(items)
+        if current is not None:
+            self.set_current(user_id, current)
+
+    def schedule_idle(self, timer, stage):
+        """Ставит проверку простоя таймера от его последней отметки (повторная постановка не дублирует)"""
+        after = self._idle_after[stage]
+        if after is None:
+            return
+        mark = timer.intervals[-1]
+        if self._scheduled.get(timer.id) == (mark, stage):
+            return
+        self._scheduled[timer.id] = (mark, stage)
+        heapq.heappush(self._idle, (mark + after, timer.id, mark, stage))
+
+    def pop_idle(self, now_ts):
+        """Возвращает [(timer, стадия)] с наступившим сроком, не просматривая остальные таймеры"""
+        due = []
+        while self._idle and self._idle[0][0] <= now_ts:
+            _, timer_id, mark, stage = heapq.heappop(self._idle)
+            # Проверку переставили (пауза, продолжение, напоминание) — запись устарела
+            if self._scheduled.get(timer_id) != (mark, stage):
+                continue
+            del self._scheduled[timer_id]
+            timer = self._by_id.get(timer_id)
+            if timer is None or timer.intervals[-1] != mark:
+                continue  # таймер завершен
+            due.append((timer, stage))
+        return due
+
+    def get(self, user_id, timer_id):
+        """Возвращает таймер, только если он принадлежит пользователю"""
+        timer = self._by_id.get(timer_id)
+        if timer is None or timer.user_id != user_id:
+            return None
+        return timer
+
+    def running(self, user_id):
+        """Все запущенные таймеры пользователя в порядке запуска"""
+        return list(self._by_user.get(user_id, {}).values())
+
+    def current(self, user_id):
+        """Текущий таймер диалога; если таймер у пользователя один — он"""
+        timer_id = self._current.get(user_id)
+        if timer_id is not None:
+            return self._by_id.get(timer_id)
+        timers = self._by_user.get(user_id)
+        if timers and len(timers) == 1:
+            return next(iter(timers.values()))
+        return None
+
+    def current_id(self, user_id):
+        """id таймера, с которым идет диалог (None — не выбран)"""
+        return self._current.get(user_id)
+
+    def set_current(self, user_id, timer_id):
+        if self.get(user_id, timer_id) is not None:
+            self._current[user_id] = timer_id
+
+    def remove(self, user_id, timer_id):
+        """Удаляет таймер и возвращает его (или None)"""
+        timer = self.get(user_id, timer_id)
+        if timer is None:
+            return None
+        del self._by_id[timer_id]
+        timers = self._by_user[user_id]
+        del timers[timer_id]
+        if not timers:
+            del self._by_user[user_id]
+        if self._current.get(user_id) == timer_id:
+            del self._current[user_id]
+        return timer
+
+    def __contains__(self, user_id):
+        return user_id in self._by_user
+
+    def __len__(self):
+        return len(self._by_id)
@@ -0,0 +1,139 @@
+import hmac
+import logging
+import time
+
+from aiohttp import web
+from telegram import Update
+
+from rate_limiter import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+MAX_UPDATE_SIZE = 1024 * 1024  # байт: обновления Telegram намного меньше
+
+# Отклоненные запросы с одного IP: не больше IP_BURST подряд, дальше IP_RATE в секунду
+IP_RATE = 1
+IP_BURST = 20
+MAX_TRACKED_IPS = 10000
+
+
+class IpLimiter:
+    """Ограничение отклоненных запросов по IP
+
+    Каждый отклоненный запрос (чужой секрет, неизвестный путь) тратит токен
+    IP-адреса; когда токены кончились, запросы с этого адреса получают 429
+    до маршрутизации. Запросы с верным секретом лимит не проверяет.
+    """
+
+    def __init__(self, rate=IP_RATE, burst=IP_BURST):
+        self.rate = rate
+        self.burst = burst
+        self._buckets = {}  # {ip: TokenBucket}
+        self.rejected = 0   # запросов, отклоненных лимитом
+
+    def blocked(self, ip, now):
+        bucket = self._buckets.get(ip)
+        if bucket is not None and bucket.wait_time(now) > 0:
+            self.rejected += 1
+            return True
+        return False
+
+    def charge(self, ip, now):
+        bucket = self._buckets.get(ip)
+        if bucket is None:
+            if len(self._buckets) >= MAX_TRACKED_IPS:
+                self._buckets = {key: value for key, value in self._buckets.items() if not value.full(now)}
+            bucket = self._buckets[ip] = TokenBucket(self.rate, self.burst, now)
+        bucket.take()
+
+
+def client_ip(request, trust_proxy):
+    """IP клиента; за прокси (Render) — последний адрес, добавленный самим прокси
+
+    trust_proxy включают, только если перед ботом есть прокси: иначе заголовок
+    X-Forwarded-For подставляет сам клиент.
+    """
+    if trust_proxy:
+        forwarded = request.headers.get('X-Forwarded-For')
+        if forwarded:
+            return forwarded.rsplit(',', 1)[-1].strip()
+    return request.remote
+
+
+def create_web_app(application, webhook_path, secret_token, probes, queue_depth, dedupe, trust_proxy=False):
+    """aiohttp-приложение: вебхук Telegram, /healthcheck и /ready
+
+    Обновления кладутся в update_queue приложения PTB, дальше их разбирает
+    обычная обработка; повторные доставки того же update_id отбрасываются
+    до нее. Запрос без верного секрета отклоняется по заголовку, тело не
+    читается; тело, не похожее на обновление, — 400. Секрет проверяется раньше
+    лимита по IP: обновления Telegram не получают 429, даже если адрес прокси
+    общий с чужими запросами. queue_depth — функция, возвращающая {очередь: длина}.
+    """
+    limiter = IpLimiter()
+    expected_secret = secret_token.encode()
+
+    def has_secret(request):
+        return hmac.compare_digest(request.headers.get(SECRET_HEADER, '').encode(), expected_secret)
+
+    @web.middleware
+    async def limit_by_ip(request, handler):
+        if request.path == webhook_path and has_secret(request):
+            return await handler(request)
+        ip = client_ip(request, trust_proxy)
+        now = time.monotonic()
+        if limiter.blocked(ip, now):
+            return web.Response(status=429)
+        try:
+            response = await handler(request)
+        except web.HTTPException as e:
+            if e.status >= 400:
+                limiter.charge(ip, now)
+            raise
+        if response.status in (400, 403, 413):
+            limiter.charge(ip, now)
+        return response
+
+    async def handle_update(request):
+        # Проверка по заголовкам, до чтения тела
+        if not has_secret(request):
+            return web.Response(status=403)
+        if request.content_length is not None and request.content_length > MAX_UPDATE_SIZE:
+            return web.Response(status=413)
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        # Секрет верный, но тело не похоже на обновление — ошибка клиента, а не 500
+        update_id = data.get('update_id') if isinstance(data, dict) else None
+        if not isinstance(update_id, int) or isinstance(update_id, bool):
+            return web.Response(status=400)
+        try:
+            update = Update.de_json(data, application.bot)
+        except (TypeError, ValueError, KeyError, AttributeError) as e:
+            logger.warning(f"Некорректное обновление update_id={update_id}: {e}")
+            return web.Response(status=400)
+        if dedupe.is_duplicate(update_id, time.monotonic()):
+            # Отвечаем 200, чтобы Telegram перестал повторять доставку
+            logger.info(f"Повторная доставка update_id={update_id} отброшена")
+            return web.Response()
+        await application.update_queue.put(update)
+        return web.Response()
+
+    async def healthcheck(request):
+        # Живость: цикл событий отвечает, внешних вызовов нет
+        return web.Response(text='ok')
+
+    async def ready(request):
+        status = probes.status()
+        status['queues'] = queue_depth()
+        status['dedupe'] = dedupe.stats()
+        status['rejected_by_ip'] = limiter.rejected
+        return web.json_response(status, status=200 if status['ready'] else 503)
+
+    web_app = web.Application(middlewares=[limit_by_ip], client_max_size=MAX_UPDATE_SIZE)
+    web_app.router.add_post(webhook_path, handle_update)
+    web_app.router.add_get('/healthcheck', healthcheck)
+    web_app.router.add_get('/ready', ready)
+    return web_app
@@ -400,6 +400,7 @@ async def confirm_end_task(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         return ConversationHandler.END
 
 PING_INTERVAL_SECONDS = 120  # Интервал между пингами (2 минуты)
+WEBHOOK_BASE_URL = os.getenv('WEBHOOK_BASE_URL', 'https://kplusbot-timetrack.onrender.com')
 
 async def ping_server(application):
     """
@@ -408,7 +409,7 @@ async def ping_server(application):
     while True:
         async with aiohttp.ClientSession() as session:
             try:
-                response = await session.get(f"{application.url}/healthcheck")
+                response = await session.get(f"{WEBHOOK_BASE_URL}/healthcheck")
                 print(f"Пинг отправлен. Статус ответа: {response.status}")
             except Exception as e:
                 print(f"Ошибка при выполнении пинга: {e}")